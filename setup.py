@@ -23,6 +23,7 @@ setup(
     download_url="http://github.com/nicferrier/veh/downloads",
     platforms = ["any"],
     packages=['veh'],
+    scripts=['bin/vehc'],
     install_requires=['pip', 'virtualenv', 'Mercurial'],
     entry_points = {
        'console_scripts': [
@@ -0,0 +1,104 @@
+"""Tests for prefetching packages from a file:// package index.
+
+Run with:
+
+  python -m unittest discover -s tests
+"""
+from __future__ import with_statement
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+from subprocess import Popen, PIPE, STDOUT
+
+import veh
+
+SETUP_PY = """from distutils.core import setup
+setup(name="fetchpkg", version="1.0", py_modules=["fetchpkg"])
+"""
+
+CONFIG = """[packages]
+fetchpkg = fetchpkg==1.0
+
+[pip]
+download-cache = %(cache)s
+index-url = file://%(index)s
+prefetch = %(prefetch)s
+"""
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="veh-test-")
+        self.index = os.path.join(self.tmpdir, "index")
+        self.cache = os.path.join(self.tmpdir, "cache")
+        self.make_index()
+        self.venvdir = os.path.join(self.tmpdir, "venv")
+        self.make_venv()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_index(self):
+        """A file:// index with fetchpkg in it.
+
+        pip reads a file:// index like a static simple index: a
+        directory per project with an index.html linking its files.
+        """
+        src = os.path.join(self.tmpdir, "src")
+        os.mkdir(src)
+        with open(os.path.join(src, "setup.py"), "w") as out:
+            out.write(SETUP_PY)
+        with open(os.path.join(src, "fetchpkg.py"), "w") as out:
+            out.write("")
+        sdist = Popen([sys.executable, "setup.py", "-q", "sdist", "-d",
+                       os.path.join(self.index, "fetchpkg")],
+                      cwd=src, stdout=PIPE, stderr=STDOUT)
+        output = sdist.communicate()[0]
+        self.assertEqual(sdist.returncode, 0, output)
+        projectdir = os.path.join(self.index, "fetchpkg")
+        filenames = os.listdir(projectdir)
+        with open(os.path.join(projectdir, "index.html"), "w") as out:
+            for filename in filenames:
+                out.write('<a href="%s">%s</a>\n' % (filename, filename))
+
+    def make_venv(self):
+        """Just enough of a venv for prefetching: its bin/pip."""
+        bindir = os.path.join(self.venvdir, "bin")
+        os.makedirs(bindir)
+        pip = os.path.join(bindir, "pip")
+        with open(pip, "w") as out:
+            out.write('#!/bin/sh\nexec %s -m pip "$@"\n' % sys.executable)
+        os.chmod(pip, stat.S_IRWXU)
+
+    def config(self, prefetch="2"):
+        cfg = ConfigParser()
+        cfg.readfp(StringIO(CONFIG % {
+                    "cache": self.cache, "index": self.index, "prefetch": prefetch}))
+        return cfg
+
+    def test_fetches_from_the_index(self):
+        prefetcher = veh._prefetcher(self.tmpdir, self.config(), self.venvdir)
+        prefetcher.start(["fetchpkg==1.0", "missingpkg==1.0"])
+        status, seconds, output = prefetcher.wait("fetchpkg==1.0")
+        self.assertEqual(status, 0, output)
+        self.assertEqual(os.listdir(self.cache), ["fetchpkg-1.0.tar.gz"])
+        status, seconds, output = prefetcher.wait("missingpkg==1.0")
+        self.assertNotEqual(status, 0)
+        self.assertTrue("missingpkg" in output, output)
+        prefetcher.close()
+
+    def test_bad_prefetch_option(self):
+        self.assertEqual(
+            veh._prefetcher(self.tmpdir, self.config("lots"), self.venvdir), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# End
@@ -0,0 +1,145 @@
+"""Tests for veh.vcscache against local file:// repositories.
+
+Run with:
+
+  python -m unittest discover -s tests
+"""
+from __future__ import with_statement
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE, STDOUT
+
+from veh import vcscache
+
+try:
+    from pip import __version__ as PIP_VERSION
+except ImportError:
+    PIP_VERSION = None
+
+SETUP_PY = """from distutils.core import setup
+setup(name="vcspkg", version="%s", py_modules=["vcspkg"])
+"""
+
+
+def run(command, cwd=None):
+    process = Popen(command, cwd=cwd, stdout=PIPE, stderr=STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise AssertionError("%s failed: %s" % (" ".join(command), output))
+    return output
+
+
+class MirrorTestMixin(object):
+    """Mirror a local repository and install the package from the mirror.
+
+    Subclasses say which vcs and how to commit and tag in it.
+    """
+    vcs = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="veh-test-")
+        self.repo = os.path.join(self.tmpdir, "repo")
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        os.mkdir(self.repo)
+        self.init()
+        self.write_package("1.0")
+        self.commit("1.0")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_package(self, version):
+        with open(os.path.join(self.repo, "setup.py"), "w") as out:
+            out.write(SETUP_PY % version)
+        with open(os.path.join(self.repo, "vcspkg.py"), "w") as out:
+            out.write("VERSION = %r\n" % version)
+
+    def spec(self, rev):
+        return "%s+file://%s@%s#egg=vcspkg" % (self.vcs, self.repo, rev)
+
+    def install(self, spec):
+        """pip install spec into a new directory, returns its VERSION."""
+        target = tempfile.mkdtemp(dir=self.tmpdir)
+        run([sys.executable, "-m", "pip", "install", "-q", "--no-index",
+             "--no-deps", "--target", target, spec])
+        namespace = {}
+        execfile(os.path.join(target, "vcspkg.py"), namespace)
+        return namespace["VERSION"]
+
+    def test_mirror_and_install(self):
+        spec = self.spec("1.0")
+        rewritten = vcscache.mirror_specs(self.cachedir, [spec])
+        mirror = vcscache.mirror_path(self.cachedir, self.vcs, "file://%s" % self.repo)
+        self.assertTrue(os.path.isdir(mirror))
+        self.assertEqual(
+            rewritten, {spec: "%s+file://%s@1.0#egg=vcspkg" % (self.vcs, mirror)})
+        self.assertEqual(self.install(rewritten[spec]), "1.0")
+
+    def test_update_pulls_new_changes(self):
+        vcscache.mirror_specs(self.cachedir, [self.spec("1.0")])
+        self.write_package("2.0")
+        self.commit("2.0")
+        spec = self.spec("2.0")
+        rewritten = vcscache.mirror_specs(self.cachedir, [spec])
+        self.assertEqual(self.install(rewritten[spec]), "2.0")
+
+    def test_failed_update_is_not_rewritten(self):
+        spec = "%s+file://%s@1.0#egg=vcspkg" % (
+            self.vcs, os.path.join(self.tmpdir, "missing"))
+        self.assertEqual(vcscache.mirror_specs(self.cachedir, [spec]), {})
+
+
+class InstallableTest(unittest.TestCase):
+
+    def test_hg_needs_pip_19_3(self):
+        self.assertFalse(vcscache.installable("hg", "1.0.2"))
+        self.assertFalse(vcscache.installable("hg", "19.2.3"))
+        self.assertTrue(vcscache.installable("hg", "19.3"))
+        self.assertTrue(vcscache.installable("hg", "20.0b1"))
+        self.assertTrue(vcscache.installable("hg", None))
+
+    def test_git_needs_any_pip(self):
+        self.assertTrue(vcscache.installable("git", "1.0.2"))
+
+    def test_old_pip_hg_specs_are_not_mirrored(self):
+        spec = "hg+file:///nowhere@1.0#egg=vcspkg"
+        self.assertEqual(vcscache.mirror_specs("/nowhere", [spec], pip_version="1.0.2"), {})
+
+
+class GitMirrorTest(MirrorTestMixin, unittest.TestCase):
+    vcs = "git"
+
+    def init(self):
+        run(["git", "init", "-q"], cwd=self.repo)
+
+    def commit(self, tag):
+        run(["git", "add", "."], cwd=self.repo)
+        run(["git", "-c", "user.name=veh", "-c", "user.email=veh@localhost",
+             "commit", "-q", "-m", tag], cwd=self.repo)
+        run(["git", "tag", tag], cwd=self.repo)
+
+
+class HgMirrorTest(MirrorTestMixin, unittest.TestCase):
+    vcs = "hg"
+
+    def init(self):
+        run(["hg", "init", self.repo])
+
+    def commit(self, tag):
+        run(["hg", "addremove", "-q"], cwd=self.repo)
+        run(["hg", "commit", "-q", "-u", "veh", "-m", tag], cwd=self.repo)
+        run(["hg", "tag", "-u", "veh", tag], cwd=self.repo)
+
+HgMirrorTest = unittest.skipUnless(
+    find_executable("hg") and PIP_VERSION and vcscache.installable("hg", PIP_VERSION),
+    "hg, or a pip that installs hg+file:// specs, is not installed")(HgMirrorTest)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# End
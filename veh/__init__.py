@@ -29,14 +29,40 @@ from os.path import expanduser
 from StringIO import StringIO
 from subprocess import Popen
 from subprocess import PIPE
+from subprocess import STDOUT
 import tempfile
+import time
 import re
+import fcntl
+from contextlib import contextmanager
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from veh import clone
+from veh import create
+from veh import dedupe
+from veh import inventory
+from veh import lockfile
+from veh import prefetch
+from veh import revconfig
+from veh import store
+from veh import vcscache
+from veh import wheelhouse
 
 VENV_DIR = '.venvs'
 ACTIVEFILE = '.active'
+LOCKFILE = '.lock'
+TRASH_DIR = '.trash'
+REAPLOCK = '.reaping'
+SPARE_DIR = '.spare'
+SPARE_READY = '.veh-spare-ready'
 VENV_PREFIX = 'venv-'
+ACTIVATED_FILE = '.veh-activated'
+DEDUPE_INDEX = '.dedupe-index'
+# Inside a venv whose packages are being installed
+BUILDING_FILE = '.veh-building'
 
 
 class Exists(Exception):
@@ -101,13 +127,107 @@ def _clear_active(repo):
 
 
 def _mark_venv_active(repo, venv):
+    """Make venv the active venv.
+
+    The caller must hold the build lock.
+    """
     venvdir = os.path.join(repo, VENV_DIR)
     activefile = os.path.join(venvdir, ACTIVEFILE)
     tmpfile = "%s.tmp" % activefile
-    if os.path.exists(tmpfile):
-        raise Exception('tmpfile %r exists.' % tmpfile)
+    if os.path.lexists(tmpfile):
+        # We hold the lock so this was left by a veh that died
+        os.remove(tmpfile)
     os.symlink(venv, tmpfile)
     os.rename(tmpfile, activefile)
+    # Record when it was activated for the retention policy
+    with open(os.path.join(venv, ACTIVATED_FILE), "w") as out:
+        print >>out, time.time()
+
+
+@contextmanager
+def _build_lock(repo):
+    """Hold the build lock of the repo's venvs.
+
+    Only one process builds or changes the active venv at a time, any
+    others wait here until it's done. Reading the active venv doesn't
+    need the lock.
+    """
+    basepth = os.path.join(repo, VENV_DIR)
+    if not os.path.exists(basepth):
+        os.mkdir(basepth)
+    fd = os.open(os.path.join(basepth, LOCKFILE), os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            print >>sys.stderr, "waiting for another veh to finish building in %s" % repo
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+
+def _is_building(venvdir):
+    """Is the venv still having its packages installed?
+
+    A venv left building by a veh that was interrupted stays building
+    until a build is resumed in it.
+    """
+    return pathexists(os.path.join(venvdir, BUILDING_FILE))
+
+
+def _venv_ready(venvdir):
+    return bool(venvdir) and pathexists(venvdir) and not _is_building(venvdir)
+
+
+def active_venv(repo):
+    """The repo's active venv, None if it hasn't got one."""
+    venvdir = _get_active_venv(repo)
+    if venvdir and pathexists(venvdir):
+        return venvdir
+    return None
+
+
+def venv_status(repo):
+    """Whether the repo's active venv is "ready", "building" or "missing".
+
+    A venv whose build was interrupted is still building.
+    """
+    venvdir = active_venv(repo)
+    if not venvdir:
+        return "missing"
+    if _is_building(venvdir):
+        return "building"
+    return "ready"
+
+
+def _mark_building(venvdir, cfg):
+    with open(os.path.join(venvdir, BUILDING_FILE), "w") as out:
+        json.dump({"key": config_key(cfg), "started": time.time()}, out)
+
+
+def _building_key(venvdir):
+    """The config key the venv is being built for, None if it isn't."""
+    try:
+        with open(os.path.join(venvdir, BUILDING_FILE)) as fd:
+            building = json.load(fd)
+    except (IOError, ValueError), e:
+        return None
+    return building.get("key")
+
+
+def _resumable_venv(repo, cfg):
+    """Find an inactive venv left half built for the same config.
+
+    The caller must hold the build lock, so any venv still marked
+    building was left by a veh that was interrupted.
+    """
+    key = config_key(cfg)
+    for venvdir in _get_inactive_venvs(repo):
+        if _building_key(venvdir) == key:
+            return venvdir
+    return None
 
 
 def _get_inactive_venvs(repo):
@@ -116,22 +236,194 @@ def _get_inactive_venvs(repo):
         dirs = os.walk(venvdir).next()[1]
     except StopIteration, e:
         return []
+    # .active, .trash and so on are not venvs
+    dirs = [i for i in dirs if not i.startswith(".")]
     activevenv = _get_active_venv(repo)
     if activevenv:
         activevenv = os.path.basename(activevenv)
-        dirs = [i for i in dirs if i != activevenv and i != ACTIVEFILE]
+        dirs = [i for i in dirs if i != activevenv]
     dirs = [os.path.join(venvdir, i) for i in dirs]
     return dirs
 
 
-def make_venv(repo):
-    """Make a virtualenv for the specified repo"""
+def _python(cfg):
+    """The python venvs are built with, the python in the [veh] section.
+
+    None if there isn't one, virtualenv then uses the python it runs
+    with, which is taken to be the one veh runs with.
+    """
+    if cfg is None:
+        return None
+    return _cfg_get(cfg, 'veh', 'python')
+
+
+# python: its version
+_python_versions = {}
+
+def _python_version(python=None):
+    """The version of python, eg: 2.7.18, or of veh's python if it's None."""
+    if not python:
+        return sys.version.split()[0]
+    if python not in _python_versions:
+        try:
+            p = Popen([python, "-c", "import sys; sys.stdout.write(sys.version.split()[0])"],
+                      stdout=PIPE)
+            version = p.communicate()[0].strip()
+        except OSError, e:
+            raise Exception("could not run python %s: %s" % (python, e))
+        if p.returncode or not version:
+            raise Exception("could not get the version of python %s" % python)
+        _python_versions[python] = version
+    return _python_versions[python]
+
+
+def _major_minor(version):
+    return ".".join(version.split(".")[:2])
+
+
+def config_key(cfg):
+    """The venv store key of the config, see veh.store.
+
+    The key is for the python the config builds venvs with.
+    """
+    return store.config_key(cfg, _python_version(_python(cfg)))
+
+
+def _lock_key(cfg):
+    """The lock file key of the config, see veh.lockfile."""
+    return lockfile.config_key(cfg, _major_minor(_python_version(_python(cfg))))
+
+
+def _run_virtualenv(venvpath, python=None):
     # TODO read a user or site wide config file for whether to use virtualenvwrapper
     # could have a "make virtualenv config with a possible 'internal' value"
+    cmd = ["virtualenv", "--no-site-packages"]
+    if python:
+        cmd.append("--python=%s" % python)
+    _popencmd(cmd + [venvpath])
+
+
+def _create_venv(venvpath, cfg=None, python=None):
+    """Create an empty virtualenv at venvpath.
+
+    The virtualenv is made with python, or the python in the cfg's
+    [veh] section. It is laid out in-process from a seed virtualenv of
+    that python, see veh.create, unless the [veh] section says:
+
+      create = virtualenv
+
+    If that doesn't work the virtualenv script is run.
+    """
+    python = python or _python(cfg)
+    if cfg is None or _cfg_get(cfg, 'veh', 'create', 'seed') == 'seed':
+        try:
+            if create.create_from_seed(
+                create.seed_dir(), venvpath,
+                lambda path: _run_virtualenv(path, python),
+                _major_minor(_python_version(python))):
+                return
+        except Exception, e:
+            print >>sys.stderr, "creating %s from the seed failed: %s" % (venvpath, e)
+            if os.path.exists(venvpath):
+                _rm_r(venvpath)
+    _run_virtualenv(venvpath, python)
+
+
+def _spare_dir(repo, python=None):
+    """The pool of spare venvs made with python."""
+    return os.path.join(repo, VENV_DIR, SPARE_DIR,
+                        "python%s" % _major_minor(_python_version(python)))
+
+
+def _claim_spare_venv(repo, venvpath, python=None):
+    """Move a spare venv made with python from the pool to venvpath.
+
+    Returns venvpath or None if there were no spare venvs.
+    """
+    sparedir = _spare_dir(repo, python)
+    if not os.path.isdir(sparedir):
+        return None
+    for name in sorted(os.listdir(sparedir)):
+        spare = os.path.join(sparedir, name)
+        if not pathexists(os.path.join(spare, SPARE_READY)):
+            continue
+        try:
+            clone.move_virtualenv(spare, venvpath)
+        except Exception, e:
+            if pathexists(venvpath):
+                # it moved but couldn't be fixed up
+                raise
+            # someone else claimed it first
+            continue
+        os.remove(os.path.join(venvpath, SPARE_READY))
+        return venvpath
+    return None
+
+
+def fill_spare_venvs(repo, count, python=None):
+    """Create spare venvs, made with python, until there are count in
+    the pool.
+
+    Only one process fills the pool at a time, if another is already
+    filling it this returns straight away. Spares that aren't ready
+    were left by a filler that died, they are trashed.
+    """
+    sparedir = _spare_dir(repo, python)
+    if not os.path.isdir(sparedir):
+        os.makedirs(sparedir)
+    fd = os.open(os.path.join(sparedir, LOCKFILE), os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            return
+        ready = 0
+        for name in os.listdir(sparedir):
+            spare = os.path.join(sparedir, name)
+            if name.startswith("."):
+                continue
+            if pathexists(os.path.join(spare, SPARE_READY)):
+                ready += 1
+            else:
+                _trash(repo, spare)
+        while ready < count:
+            spare = tempfile.mktemp(prefix=VENV_PREFIX, dir=sparedir)
+            _create_venv(spare, python=python)
+            if not pathexists(os.path.join(spare, "bin", "python")):
+                # creating venvs doesn't work, don't keep trying
+                break
+            # only now can it be claimed
+            open(os.path.join(spare, SPARE_READY), "w").close()
+            ready += 1
+    finally:
+        os.close(fd)
+
+
+def make_venv(repo, activate=True, cfg=None):
+    """Make a virtualenv for the specified repo
+
+    If activate is False the new virtualenv is not marked active.
+
+    If the [veh] section of the cfg says:
+
+      spare-venvs = N
+
+    a pool of N already created spare venvs is kept and the new venv is
+    taken from there, and the pool refilled in the background.
+    """
     venvpath = _new_venv_path(repo)
-    _popencmd(["virtualenv", "--no-site-packages", venvpath])
+    spares = 0
+    python = _python(cfg)
+    if cfg is not None:
+        spares = int(_cfg_get(cfg, 'veh', 'spare-venvs', 0))
+    if not (spares and _claim_spare_venv(repo, venvpath, python)):
+        _create_venv(venvpath, cfg)
+    if spares:
+        _spawn_background(
+            "veh.fill_spare_venvs(%r, %d, %r)" % (repo, spares, python))
     write_startup_rc(venvpath)
-    _mark_venv_active(repo, venvpath)
+    if activate:
+        _mark_venv_active(repo, venvpath)
     return venvpath
 
 
@@ -157,6 +449,106 @@ def _rm_r(dir):
                 os.rmdir(os.path.join(r, dn))
     os.rmdir(dir)
 
+
+def _spawn_background(code):
+    """Run the python code with veh imported in a detached process.
+
+    The process is this python importing this veh, rather than setting
+    PYTHONPATH which everything the process runs would inherit.
+    """
+    vehpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    devnull = open(os.devnull, "r+")
+    try:
+        Popen([sys.executable, "-c",
+               "import sys; sys.path.insert(0, %r); import veh; %s" % (vehpath, code)],
+              stdin=devnull, stdout=devnull, stderr=devnull,
+              close_fds=True, preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+
+
+def _trash(repo, path):
+    """Delete path, a directory in the repo's .venvs, in the background.
+
+    path is renamed into the trash, which is instant, and a reaper is
+    started to actually delete it.
+    """
+    trashdir = os.path.join(repo, VENV_DIR, TRASH_DIR)
+    if not os.path.exists(trashdir):
+        os.mkdir(trashdir)
+    target = tempfile.mktemp(prefix="%s-" % os.path.basename(path), dir=trashdir)
+    os.rename(path, target)
+    _start_reaper(repo)
+
+
+def _start_reaper(repo):
+    _spawn_background("veh.reap_trash(%r)" % repo)
+
+
+def _trash_pending(repo):
+    """Is there anything in the repo's trash?"""
+    trashdir = os.path.join(repo, VENV_DIR, TRASH_DIR)
+    return os.path.isdir(trashdir) and os.listdir(trashdir) != []
+
+
+def _rm(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        _rm_r(path)
+    else:
+        os.remove(path)
+
+
+def _reap(path):
+    """_rm the path, returning the error rather than raising it."""
+    try:
+        _rm(path)
+    except EnvironmentError, e:
+        print >>sys.stderr, "could not delete %s: %s" % (path, e)
+        return e
+
+
+def reap_trash(repo, workers=4):
+    """Delete everything in the repo's trash.
+
+    The top level of each trashed directory is deleted in parallel by a
+    pool of workers. Only one reaper runs per repo, if another is
+    already running this returns straight away. Anything that can't be
+    deleted is left in the trash.
+    """
+    basepth = os.path.join(repo, VENV_DIR)
+    trashdir = os.path.join(basepth, TRASH_DIR)
+    fd = os.open(os.path.join(basepth, REAPLOCK), os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            return
+        # Keep going until the trash stays empty, more can arrive
+        failed = set()
+        while _trash_pending(repo):
+            trashed = [os.path.join(trashdir, i) for i in os.listdir(trashdir)]
+            trashed = [path for path in trashed if path not in failed]
+            if not trashed:
+                break
+            subtrees = []
+            for path in trashed:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    subtrees += [os.path.join(path, i) for i in os.listdir(path)]
+            if subtrees:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(workers)
+                try:
+                    pool.map(_reap, subtrees)
+                finally:
+                    pool.close()
+                    pool.join()
+            for path in trashed:
+                if _reap(path):
+                    failed.add(path)
+    finally:
+        os.close(fd)
+
+
 def _venvsh(root, venvdir, shellcommand=None, exec_=False, pipe=False):
     """Run the shellcommand inside the specified venv.
 
@@ -200,12 +592,172 @@ def _venvsh(root, venvdir, shellcommand=None, exec_=False, pipe=False):
         return _popencmd(command, env=env, pipe=pipe)
 
 
+def _venv_environ(root, venvdir):
+    """Make the environment that activating venvdir would make.
+
+    This is what bin/activate does, without running a shell.
+    """
+    env = os.environ.copy()
+    env["VEHACTIVE"] = root
+    env["VIRTUAL_ENV"] = venvdir
+    env["PATH"] = os.pathsep.join(
+        [os.path.join(venvdir, "bin"), env.get("PATH", os.defpath)])
+    env.pop("PYTHONHOME", None)
+    return env
+
+
 def cleanup_inactive_venvs(repo):
     "Deletes inactive virtualenv directories."
     dirs = _get_inactive_venvs(repo)
     for dir in dirs:
         sys.stdout.write("removing %s\n" % dir)
-        _rm_r(dir)
+        _trash(repo, dir)
+
+def _finished_venvs(repo):
+    """The repo's venvs that are completely made, the active one first."""
+    venvdirs = [_get_active_venv(repo)] + _get_inactive_venvs(repo)
+    return [v for v in venvdirs
+            if v and pathexists(os.path.join(v, ".startup_rc")) and not _is_building(v)]
+
+
+def _locked_venvs(repos, locked=None):
+    """Yield the list of finished venvs of each of repos.
+
+    The build lock of each repo is held while its venvs are being
+    used, so none of them are built meanwhile, except for the repo
+    locked, whose lock the caller holds.
+    """
+    for repo in repos:
+        if repo == locked:
+            yield _finished_venvs(repo)
+        else:
+            with _build_lock(repo):
+                yield _finished_venvs(repo)
+
+
+def dedupe_venvs(root, locked=None):
+    """Hardlink identical files across venvs, see veh.dedupe.
+
+    If root is a repository with venvs its venvs are deduped, otherwise
+    the venvs of every repository under root are, each repository's on
+    their own. Repositories aren't looked for inside a repository. The
+    dedupe index is kept in the repository's VENV_DIR or at the top of
+    root.
+
+    locked is a repository whose build lock the caller holds.
+
+    Returns (linked, saved), the number of files linked and the bytes
+    that saved.
+    """
+    if os.path.isdir(os.path.join(root, VENV_DIR)):
+        repos = [root]
+        indexfile = os.path.join(root, VENV_DIR, DEDUPE_INDEX)
+    else:
+        repos = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            if VENV_DIR in dirnames:
+                repos.append(dirpath)
+                # don't walk the repository's source tree
+                dirnames[:] = []
+            # the vc directories don't hold repositories
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        indexfile = os.path.join(root, ".veh%s" % DEDUPE_INDEX)
+    return dedupe.dedupe(_locked_venvs(repos, locked), indexfile)
+
+
+def _last_activated(venv):
+    """When the venv was last made active, or made if it never was."""
+    try:
+        return os.stat(os.path.join(venv, ACTIVATED_FILE)).st_mtime
+    except OSError, e:
+        return os.stat(venv).st_mtime
+
+
+def _du(path, seen):
+    """Bytes used under path, files in seen (by device and inode) are
+    not counted again so hardlinked clones aren't counted twice."""
+    total = 0
+    for r, dirs, files in os.walk(path):
+        for fn in files:
+            st = os.lstat(os.path.join(r, fn))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+_SIZE_UNITS = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+def _parse_size(size):
+    """Parse a size like 500M or 2g into bytes."""
+    size = size.strip().lower()
+    if size[-1:] in _SIZE_UNITS:
+        return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def _retention_limit(cfg, option, parse):
+    """The parsed [veh] option, None if it isn't set or doesn't parse."""
+    value = _cfg_get(cfg, 'veh', option)
+    if value is None:
+        return None
+    try:
+        limit = parse(value)
+    except ValueError, e:
+        limit = -1
+    if limit < 0:
+        print >>sys.stderr, "%s in the [veh] section is not valid, ignoring it" % option
+        return None
+    return limit
+
+
+def apply_retention(repo, cfg):
+    """Delete inactive venvs according to the retention policy.
+
+    The policy is in the [veh] section:
+
+      keep-venvs = N        keep at most N inactive venvs
+      max-venv-age = DAYS   delete inactive venvs not active for DAYS
+      max-venvs-size = SIZE delete inactive venvs until all the venvs
+                            take up less than SIZE (eg: 500M, 2G)
+
+    The least recently activated venvs go first. The active venv is
+    never deleted. A limit that isn't valid is ignored. Returns the list
+    of deleted venvs.
+    """
+    keep = _retention_limit(cfg, 'keep-venvs', int)
+    max_age = _retention_limit(cfg, 'max-venv-age', float)
+    max_size = _retention_limit(cfg, 'max-venvs-size', _parse_size)
+    if keep is None and max_age is None and max_size is None:
+        return []
+
+    # most recently activated first
+    inactive = sorted(_get_inactive_venvs(repo), key=_last_activated, reverse=True)
+    evict = []
+    if keep is not None:
+        evict += inactive[keep:]
+        inactive = inactive[:keep]
+    if max_age is not None:
+        cutoff = time.time() - max_age * 24 * 60 * 60
+        evict += [v for v in inactive if _last_activated(v) < cutoff]
+        inactive = [v for v in inactive if v not in evict]
+    if max_size is not None:
+        seen = set()
+        active = _get_active_venv(repo)
+        total = active and _du(active, seen) or 0
+        sizes = [(v, _du(v, seen)) for v in inactive]
+        total += sum(size for v, size in sizes)
+        while sizes and total > max_size:
+            v, size = sizes.pop()
+            total -= size
+            evict.append(v)
+
+    for v in evict:
+        sys.stdout.write("removing %s\n" % v)
+        _trash(repo, v)
+    return evict
+
 
 # Packages that we should force easy_install for.
 # This should probably be configurable inside veh.
@@ -217,7 +769,8 @@ FORCE_EASY_INSTALL = [
 def get_config(repo, rev=None):
     """Get the config from the veh root.
 
-Using a specified rev only works on Mercurial repos right now."""
+Using a specified rev works on Mercurial and git repos, see
+veh.revconfig."""
     if not rev:
         repo_root = find_root_with_file(".veh.conf", repo)
         cfgfile = os.path.join(repo_root, '.veh.conf')
@@ -231,119 +784,868 @@ Using a specified rev only works on Mercurial repos right now."""
         return cfg
 
     else:
-        # This obviously needs fixing to be DVCS agnostic
-
-        from mercurial import hg, ui, error
-        # NOTE: rev = None in the mercurial api will give you the working dir.
-        u = ui.ui()
-        try:
-            repo = hg.repository(u, repo)
-        except error.RepoError, e:
-            # repo not found
-            raise
-        try:
-            cfgdata = repo[rev]['.veh.conf'].data()
-        except error.RepoLookupError, e:
-            # revision not found
-            raise
-        except error.LookupError, e:
-            # config not found
-            cfgfile = os.path.join(repo.root, '.veh.conf')
-            raise ConfigMissing(cfgfile)
+        return get_configs(repo, [rev])[0][1]
 
-        cfg = ConfigParser()
-        cfg.readfp(StringIO(cfgdata), '.veh.conf')
-        return cfg
 
+def get_configs(repo, revs):
+    """Get the config at each of the revs.
 
-PIP_VERSION_RE=re.compile("(?P<packagename>[^=]+)==(?P<version>[0-9.]+)")
+Returns a list of (rev, config). The repository is kept open between
+calls so this is quick for lots of revs."""
+    configs = revconfig.read_configs(repo, revs)
+    for rev, cfg in configs:
+        if cfg is None:
+            cfgfile = os.path.join(repo, '.veh.conf')
+            raise ConfigMissing("%s at %s" % (cfgfile, rev))
+    return configs
 
-def _pip_freeze(root, venv):
-    """Runs pip freeze in the specified virtual env.
 
-    Returns a list of packages with the key the packagename and the
-    value the version.
-    """
-    process = _venvsh(root, venv, "pip freeze", pipe=True)
-    stdout, stderr = process.communicate()
-    specs = stdout.split("\n")
-    packages = {}
-    for spec in specs:
-        if spec:
-            m = PIP_VERSION_RE.match(spec)
-            if m:
-                packages[m.group("packagename")] = m.group("version")
-    return packages
+PIP_VERSION_RE=re.compile("(?P<packagename>[^=]+)==(?P<version>[^\s;]+)")
 
 # This variable controls whether we check inside virtualenvs for version differences
 # It's not necessary since we use PIP inside the venv now and that checks
 VIRTUALENV_VERSION_PEEKING = False
 
-def fill_venv(repo, cfg=None):
-    """Install packages into the venv.
+def _cfg_get(cfg, section, option, default=None):
+    """Get an option from the config returning default if it's not there."""
+    try:
+        return cfg.get(section, option)
+    except (NoSectionError, NoOptionError), e:
+        return default
+
 
-    Makes the venv if it needs to.
+def _cfg_getboolean(cfg, section, option, default=False):
+    """Get a boolean option from the config returning default if it's not there."""
+    try:
+        return cfg.getboolean(section, option)
+    except (NoSectionError, NoOptionError), e:
+        return default
+
+
+def _download_cache_dir(cfg):
+    """The download-cache directory from the [pip] config, made if need be.
+
+    None if there isn't one or it can't be made.
     """
-    venvdir = _get_active_venv(repo)
-    if not venvdir or not pathexists(venvdir):
-        venvdir = make_venv(repo)
+    if not cfg.has_option("pip", "download-cache"):
+        return None
+    cachedir = expanduser(cfg.get("pip", "download-cache"))
+    try:
+        if not pathexists(cachedir):
+            os.mkdir(cachedir)
+    except:
+        print >>sys.stderr, "%s does not exist but cannot be created" % cachedir
+        return None
+    return cachedir
+
+
+def _index_options(cfg):
+    """The package index options from the [pip] config."""
+    index_url = _cfg_get(cfg, 'pip', 'index-url')
+    if index_url:
+        return " --index-url=%s" % index_url
+    return ""
+
+
+def _pip_command(cfg, upgrade=False, find_links=None, prefetched=None,
+                 download_cache=True):
+    """Make the pip install command line from the [pip] config.
+
+    find_links is a list of local directories to install from instead
+    of the package index.
+
+    prefetched is a directory of prefetched artifacts to try before the
+    package index.
+
+    --download-cache is only passed if download_cache is True and the
+    [pip] section doesn't prefetch: pip 8 removed the option, and
+    prefetching needs pip 8's "pip download".
+    """
+    cmd = "pip install -v"
+    if upgrade:
+        cmd += " --upgrade"
+    if find_links:
+        cmd += " --no-index"
+        for link in find_links:
+            cmd += " --find-links=%s" % link
+    elif prefetched:
+        cmd += " --find-links=%s" % prefetched
+    cmd += _index_options(cfg)
+
+    # Some things that you can specify about pip with veh config
+    if _cfg_getboolean(cfg, 'pip', 'always-upgrade'):
+        ## FIXME we've turned this off now we're using pip inside the venv
+        #cmd += ' --upgrade'
+        pass
+
+    if download_cache and not _cfg_get(cfg, 'pip', 'prefetch'):
+        cachedir = _download_cache_dir(cfg)
+        if cachedir:
+            cmd += " --download-cache=%s" % cachedir
+    return cmd
+
+
+def _prefetcher(repo, cfg, venvdir):
+    """Make a Prefetcher fetching packages into the download cache.
+
+    Only if the [pip] section has a download-cache and says how many
+    packages to fetch at once:
+
+      prefetch = 4
+    """
+    try:
+        workers = int(_cfg_get(cfg, 'pip', 'prefetch', 0))
+    except ValueError, e:
+        print >>sys.stderr, "prefetch in the [pip] section is not a number, not prefetching"
+        return None
+    cachedir = _download_cache_dir(cfg)
+    if not (workers > 0 and cachedir):
+        return None
+
+    # pip is run directly, a shell for each fetch would run the rc files
+    env = _venv_environ(repo, venvdir)
+    pip = os.path.join(venvdir, "bin", "pip")
+
+    def fetch(package_name):
+        download = Popen(
+            [pip, "download", "--no-deps", "-d", cachedir]
+            + _index_options(cfg).split() + [package_name],
+            env=env, stdout=PIPE, stderr=STDOUT)
+        output = download.communicate()[0]
+        return download.returncode, output
+    return prefetch.Prefetcher(fetch, workers)
+
+
+def _is_easy_install(package):
+    """Is the (label, spec) package one that pip can't install?"""
+    package_name = package[1] or package[0]
+    return package[0] in FORCE_EASY_INSTALL or package_name in FORCE_EASY_INSTALL
+
+
+# The requirements file written into the venv by the batch install mode
+REQUIREMENTS_FILE = '.veh-requirements.txt'
+
+def _vcs_cache_dir(cfg):
+    """The vcs cache directory from the [veh] config, if there is one."""
+    vcs_cache = _cfg_get(cfg, 'veh', 'vcs-cache')
+    if vcs_cache:
+        return expanduser(vcs_cache)
+    return None
+
+
+def _wheelhouse_dir(cfg):
+    """The wheelhouse directory from the [pip] config, if there is one."""
+    wheelhouse_dir = _cfg_get(cfg, 'pip', 'wheelhouse')
+    if wheelhouse_dir:
+        return expanduser(wheelhouse_dir)
+    return None
+
+
+# The report of the last build kept inside each venv
+REPORT_FILE = '.veh-build.json'
+
+class BuildReport(object):
+    """Records how long each install of a build takes.
+
+    Each install command is run through the report, which records the
+    wall time, exit status, installer and bytes the venv grew by.
+    The report is written as JSON to REPORT_FILE inside the venv.
+    """
+
+    def __init__(self, repo, venvdir):
+        self.repo = repo
+        self.venvdir = venvdir
+        self.started = time.time()
+        self.packages = []
+        self.fetches = []
+        # site-packages entry: (mtime, bytes)
+        self.sizes = None
+        self.size = None
+
+    def _measure(self):
+        """The bytes used by the venv.
+
+        Installs add and replace entries at the top of site-packages,
+        which changes their mtime, so only the entries whose mtime has
+        changed since the last measurement are measured again. The rest
+        of the venv, scripts, headers and data files, is small and
+        measured in full.
+        """
+        sitedirs = inventory.site_packages(self.venvdir)
+        total = 0
+        for r, dirs, files in os.walk(self.venvdir):
+            if r in sitedirs:
+                dirs[:] = []
+                continue
+            for fn in files:
+                try:
+                    total += os.lstat(os.path.join(r, fn)).st_size
+                except OSError, e:
+                    continue
+        sizes = {}
+        for sitedir in sitedirs:
+            for name in os.listdir(sitedir):
+                path = os.path.join(sitedir, name)
+                try:
+                    st = os.lstat(path)
+                except OSError, e:
+                    continue
+                old = self.sizes and self.sizes.get(path)
+                if old and old[0] == st.st_mtime:
+                    sizes[path] = old
+                elif os.path.isdir(path) and not os.path.islink(path):
+                    sizes[path] = (st.st_mtime, _du(path, set()))
+                else:
+                    sizes[path] = (st.st_mtime, st.st_size)
+        self.sizes = sizes
+        return total + sum(size for mtime, size in sizes.itervalues())
+
+    def run(self, label, installer, command):
+        """Run the install command for the package label in the venv."""
+        if self.size is None:
+            self.size = self._measure()
+        started = time.time()
+        process = _venvsh(self.repo, self.venvdir, command)
+        seconds = time.time() - started
+        size = self._measure()
+        self.packages.append({
+                "package": label,
+                "installer": installer,
+                "status": process.returncode,
+                "seconds": seconds,
+                "bytes": size - self.size,
+                })
+        self.size = size
+        return process
+
+    def fetched(self, label, status, seconds):
+        """Record how long prefetching the package label's artifact took."""
+        self.fetches.append({
+                "package": label,
+                "status": status,
+                "seconds": seconds,
+                })
+
+    def write(self):
+        finished = time.time()
+        with open(os.path.join(self.venvdir, REPORT_FILE), "w") as out:
+            json.dump({
+                    "started": self.started,
+                    "finished": finished,
+                    "seconds": finished - self.started,
+                    "packages": self.packages,
+                    "fetches": self.fetches,
+                    }, out, indent=2, sort_keys=True)
+
+
+def read_report(venvdir):
+    """Read the build report from the venv, None if there isn't one."""
+    reportfile = os.path.join(venvdir, REPORT_FILE)
+    if not pathexists(reportfile):
+        return None
+    with open(reportfile) as fd:
+        return json.load(fd)
+
+
+def fill_wheelhouse(repo, venvdir, wheelhouse_dir, package_names, report=None,
+                    held=None):
+    """Make sure every one of package_names is built in the wheelhouse.
 
+    Missing packages are built with the venv's pip, through the
+    BuildReport if there is one. Returns a dict of package name to
+    wheelhouse entry for the packages that are there.
+
+    The entries are held, so they aren't pruned, until the locks put in
+    the held list are closed or thrown away.
+    """
+    if held is None:
+        held = []
+    abi = wheelhouse.abi_tag(venvdir)
+    entries = {}
+    for package_name in package_names:
+        used = wheelhouse.use(wheelhouse_dir, abi, package_name)
+        if not used:
+            builddir = wheelhouse.prepare(wheelhouse_dir, abi, package_name)
+            build_command = "%s %s" % (wheelhouse.build_command(builddir), package_name)
+            if report:
+                build = report.run(package_name, "pip wheel", build_command)
+            else:
+                build = _venvsh(repo, venvdir, build_command)
+            if build.returncode:
+                print >>sys.stderr, "could not build %s into the wheelhouse" % package_name
+                wheelhouse.abandon(builddir)
+                continue
+            used = wheelhouse.complete(wheelhouse_dir, abi, package_name, builddir)
+        entry, lock = used
+        held.append(lock)
+        entries[package_name] = entry
+    return entries
+
+
+def _batch_install(report, cfg, package_names, upgrade=False, find_links=None,
+                   prefetched=None):
+    """Install all the package_names with a single pip run.
+
+    The packages are written to a requirements file inside the venv so
+    pip resolves them all together.
+    """
+    venvdir = report.venvdir
+    if not package_names:
+        return None
+    reqfile = os.path.join(venvdir, REQUIREMENTS_FILE)
+    with open(reqfile, "w") as out:
+        for package_name in package_names:
+            print >>out, package_name
+    pip_command = "%s -r %s" % (
+        _pip_command(cfg, upgrade=upgrade, find_links=find_links,
+                     prefetched=prefetched),
+        reqfile)
+    return report.run(", ".join(package_names), "pip -r", pip_command)
+
+
+# The manifest of installed config entries kept inside each venv
+MANIFEST_FILE = '.veh-manifest'
+
+def _read_manifest(venvdir):
+    """Read the venv's manifest of installed packages.
+
+    The manifest is a dict with:
+
+      packages -- the config entries (label: spec) that were installed
+      resolved -- for each label the [name, version] it installed as
+
+    A venv without a manifest gives an empty one.
+    """
+    manifest = {"packages": {}, "resolved": {}}
+    manifestfile = os.path.join(venvdir, MANIFEST_FILE)
+    if pathexists(manifestfile):
+        with open(manifestfile) as fd:
+            manifest.update(json.load(fd))
+    return manifest
+
+
+def _write_manifest(venvdir, manifest):
+    manifestfile = os.path.join(venvdir, MANIFEST_FILE)
+    tmpfile = "%s.tmp" % manifestfile
+    with open(tmpfile, "w") as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+    os.rename(tmpfile, manifestfile)
+
+
+def _requirement_name(label, spec):
+    """Work out the distribution name a config entry installs.
+
+    Plain requirements give their project name, urls and vc references
+    give their #egg= name or, failing that, the package label.
+    """
+    if "#egg=" in spec:
+        return spec.split("#egg=", 1)[1].split("&")[0]
+    if not spec or not _is_index_requirement(spec):
+        return label
+    return re.split("[<>=!~;\[ ]", spec, 1)[0].strip() or label
+
+
+def _is_index_requirement(spec):
+    """Is the spec looked up on the package index, rather than being a
+    url, vc reference or path?"""
+    return not ("://" in spec or "+" in spec.split("/")[0] or os.sep in spec)
+
+
+def _package_delta(manifest, packages):
+    """Diff the manifest against the config packages.
+
+    Returns (install, upgrade, remove) where install and upgrade are
+    lists of (label, spec) and remove is the list of labels that are no
+    longer in the config.
+    """
+    installed = manifest["packages"]
+    install, upgrade = [], []
+    for label, spec in packages:
+        if label not in installed:
+            install.append((label, spec))
+        elif installed[label] != spec:
+            upgrade.append((label, spec))
+    labels = set(label for label, spec in packages)
+    remove = [label for label in installed if label not in labels]
+    return install, upgrade, remove
+
+
+def _checkpoint(venvdir, manifest, packages):
+    """Record that packages got installed, and how they resolved, in
+    the manifest."""
+    installed = inventory.index(inventory.installed(venvdir))
+    for label, spec in packages:
+        name = _requirement_name(label, spec)
+        manifest["packages"][label] = spec
+        manifest["resolved"][label] = [name, installed.get(inventory.normalize_name(name))]
+    _write_manifest(venvdir, manifest)
+
+
+def _wait_prefetched(report, cfg, prefetcher, packages):
+    """Wait for the packages' prefetches, recording them in the report.
+
+    Returns the download cache if any of them were fetched.
+    """
+    if not prefetcher:
+        return None
+    fetched = False
+    for label, spec in packages:
+        if (spec or label) in prefetcher:
+            status, seconds, output = prefetcher.wait(spec or label)
+            report.fetched(label, status, seconds)
+            if status:
+                print >>sys.stderr, "prefetching %s failed, installing it from the index" % (
+                    spec or label)
+                if output.strip():
+                    print >>sys.stderr, output.rstrip()
+            fetched = fetched or not status
+    if fetched:
+        return _download_cache_dir(cfg)
+    return None
+
+
+def lock_venv(repo, cfg, venvdir):
+    """Write the lock file pinning everything installed in the venv.
+
+    Each installed package's artifact is downloaded with the venv's pip
+    to get its hash. The config entries that aren't on the package
+    index are locked by their spec.
+
+    If any other installed package couldn't be downloaded, a develop
+    install say, no lock is written. Returns the (name, version) of
+    those packages.
+    """
+    key = _lock_key(cfg)
+    resolved = _read_manifest(venvdir)["resolved"]
+    specs = []
+    byspec = set()
+    for label, spec in cfg.items("packages"):
+        if spec and not _is_index_requirement(spec):
+            specs.append(spec)
+            name = resolved.get(label, [_requirement_name(label, spec)])[0]
+            byspec.add(inventory.normalize_name(name))
+
+    downloads = tempfile.mkdtemp(prefix="veh-lock-")
+    pins = []
+    unhashed = []
+    try:
+        for name, version in lockfile.closure(inventory.installed(venvdir)):
+            if inventory.normalize_name(name) in byspec:
+                continue
+            downloaddir = os.path.join(downloads, inventory.normalize_name(name))
+            os.mkdir(downloaddir)
+            download = _venvsh(
+                repo, venvdir,
+                "pip download --no-deps -d %s %s==%s" % (downloaddir, name, version))
+            artifacts = os.listdir(downloaddir)
+            if not download.returncode and len(artifacts) == 1:
+                digest = lockfile.file_hash(os.path.join(downloaddir, artifacts[0]))
+                pins.append((name, version, digest))
+            else:
+                unhashed.append((name, version))
+    finally:
+        _rm_r(downloads)
+    if not unhashed:
+        lockfile.write(repo, key, pins, specs)
+    return unhashed
+
+
+def _install_locked(report, cfg):
+    """Install the lock file, see veh.lockfile.
+
+    The hashed pins are installed with one pip run and the specs with a
+    pip run each. Returns the install processes.
+    """
+    key, lines = lockfile.read(report.repo)
+    pins, specs = lockfile.split(lines)
+    installs = []
+    if pins:
+        reqfile = os.path.join(report.venvdir, REQUIREMENTS_FILE)
+        with open(reqfile, "w") as out:
+            for pin in pins:
+                print >>out, pin
+        # --require-hashes is pip 8, which has no --download-cache
+        pip_command = "%s --no-deps --require-hashes -r %s" % (
+            _pip_command(cfg, download_cache=False), reqfile)
+        installs.append(report.run(lockfile.LOCK_FILE, "pip -r", pip_command))
+    for spec in specs:
+        pip_command = "%s --no-deps %s" % (_pip_command(cfg, download_cache=False), spec)
+        installs.append(report.run(spec, "pip", pip_command))
+    return installs
+
+
+def fill_venv(repo, cfg=None, venvdir=None, use_lock=True):
+    """Install packages into the venv.
+
+    The venv is venvdir or the active venv. Makes the venv if it needs
+    to.
+
+    The venv keeps a manifest of the config entries installed in it so
+    only the difference with the config is done: new packages are
+    installed, packages whose spec changed are upgraded and packages
+    that were removed from the config are uninstalled.
+
+    Packages are installed one at a time unless the [veh] section says:
+
+      install-mode = batch
+
+    in which case all the pip packages are installed with one pip run.
+
+    The time each install takes is recorded in a BuildReport in the
+    venv.
+
+    If the [pip] section has a wheelhouse the pip packages are built
+    into it first, if they're not already there, and installed from it
+    without using the package index.
+
+    While packages are being installed the venv is marked building and
+    the manifest is written after each package, so if the build is
+    interrupted the next fill_venv carries on from the first package
+    that wasn't finished.
+
+    If the [veh] section has a vcs-cache the repositories of vc specs
+    are mirrored there, see veh.vcscache, and installed from the
+    mirrors.
+
+    If the [pip] section has a download-cache and prefetch the pip
+    packages are all fetched into the download cache, in parallel, as
+    soon as the install starts, see veh.prefetch.
+
+    If there's a lock file current for the config (see veh.lockfile)
+    everything is installed from it, with no resolution, instead. That
+    doesn't happen if use_lock is False.
+
+    Returns True if every install and uninstall command succeeded.
+    """
     if cfg is None:
         cfg = get_config(repo)
 
+    if venvdir is None:
+        venvdir = _get_active_venv(repo)
+        if not venvdir or not pathexists(venvdir):
+            venvdir = make_venv(repo, cfg=cfg)
+
+    manifest = _read_manifest(venvdir)
+    install, upgrade, remove = _package_delta(manifest, cfg.items("packages"))
+    if install or upgrade or remove:
+        _mark_building(venvdir, cfg)
+
+    batch = _cfg_get(cfg, 'veh', 'install-mode', 'package') == 'batch'
+    batched = []
+    installers = []
+    done = []
     installed_list = {}
+    report = BuildReport(repo, venvdir)
+
+    # Uninstall the packages that have gone from the config, the
+    # manifest keeps the ones that fail so they're tried again
+    for label in remove:
+        name = manifest["resolved"].get(label, [label])[0]
+        uninstaller = report.run(label, "pip uninstall", "pip uninstall -y %s" % name)
+        installers.append(uninstaller)
+        if uninstaller.returncode:
+            print >>sys.stderr, "could not uninstall %s" % name
+            continue
+        del manifest["packages"][label]
+        manifest["resolved"].pop(label, None)
+        _write_manifest(venvdir, manifest)
+
+    # A current lock pins everything so just install that
+    if (install or upgrade) and use_lock and lockfile.current(repo, _lock_key(cfg)):
+        locked = _install_locked(report, cfg)
+        if [p for p in locked if p.returncode]:
+            # the packages get resolved as usual instead
+            print >>sys.stderr, "installing from %s failed, resolving the packages instead" % (
+                lockfile.LOCK_FILE)
+        else:
+            installers.extend(locked)
+            _checkpoint(venvdir, manifest, install + upgrade)
+            install, upgrade = [], []
+
+    # Start fetching the pip packages while everything else goes on
+    prefetcher = _prefetcher(repo, cfg, venvdir)
+    if prefetcher:
+        prefetcher.start([p[1] or p[0] for p in install + upgrade
+                          if not _is_easy_install(p) and not vcscache.parse(p[1] or p[0])])
+
+    # Bring the mirrors of the vc packages up to date
+    mirrored = {}
+    vcs_cache = _vcs_cache_dir(cfg)
+    if vcs_cache:
+        pip_version = inventory.index(inventory.installed(venvdir)).get("pip")
+        mirrored = vcscache.mirror_specs(
+            vcs_cache,
+            [p[1] or p[0] for p in install + upgrade if not _is_easy_install(p)],
+            pip_version=pip_version)
+
+    # Make sure the pip packages are built in the wheelhouse
+    wheels = {}
+    # the locks holding the wheelhouse entries while they're installed from
+    held = []
+    wheelhouse_dir = _wheelhouse_dir(cfg)
+    if wheelhouse_dir:
+        wheels = fill_wheelhouse(
+            repo, venvdir, wheelhouse_dir,
+            [p[1] or p[0] for p in install + upgrade if not _is_easy_install(p)],
+            report, held)
 
     # Install each package in the venv
     venviron = venvdir
-    packages = cfg.items("packages")
-    for package in packages:
+    for package in install + upgrade:
         package_name = package[1] or package[0]
+        upgrading = package in upgrade
 
         # Have you already got installed the version that is being requested
         if VIRTUALENV_VERSION_PEEKING:
             if not installed_list:
-                installed_list = _pip_freeze(repo, venvdir) 
+                installed_list = inventory.index(inventory.installed(venvdir))
             packagespec = PIP_VERSION_RE.match(package_name)
             if packagespec:
-                if packagespec.group("version") == installed_list[packagespec.group("packagename")]:
+                packagename = inventory.normalize_name(packagespec.group("packagename"))
+                if packagespec.group("version") == installed_list.get(packagename):
+                    done.append(package)
                     continue
 
         # Check whether pip can't install it.
-        if package[0] in FORCE_EASY_INSTALL or package_name in FORCE_EASY_INSTALL:
-            ez_command = "easy_install %s" % package_name
-            ez = _venvsh(repo, venvdir, ez_command)
+        if _is_easy_install(package):
+            ez_command = "easy_install %s%s" % ("-U " if upgrading else "", package_name)
+            ez = report.run(package[0], "easy_install", ez_command)
+            installers.append(ez)
+            if not ez.returncode:
+                _checkpoint(venvdir, manifest, [package])
+        elif batch:
+            batched.append(package)
         else:
             # Use pip to install into the venv
-            cmd = "pip install -v"
+            find_links = package_name in wheels and [wheels[package_name]]
+            prefetched = _wait_prefetched(report, cfg, prefetcher, [package])
+            pip_command = "%s %s" % (
+                _pip_command(cfg, upgrade=upgrading, find_links=find_links,
+                             prefetched=prefetched),
+                mirrored.get(package_name, package_name))
+            pip = report.run(package[0], "pip", pip_command)
+            installers.append(pip)
+            if not pip.returncode:
+                _checkpoint(venvdir, manifest, [package])
+
+    if batched:
+        batched_names = [p[1] or p[0] for p in batched]
+        # Only go offline if the wheelhouse has everything
+        find_links = None
+        if not [n for n in batched_names if n not in wheels]:
+            find_links = [wheels[n] for n in batched_names]
+        pip = _batch_install(
+            report, cfg, [mirrored.get(n, n) for n in batched_names],
+            upgrade=[p for p in batched if p in upgrade] != [],
+            find_links=find_links,
+            prefetched=_wait_prefetched(report, cfg, prefetcher, batched))
+        installers.append(pip)
+        if not pip.returncode:
+            _checkpoint(venvdir, manifest, batched)
+
+    if done:
+        _checkpoint(venvdir, manifest, done)
+
+    if prefetcher:
+        prefetcher.close()
+    for lock in held:
+        lock.close()
+
+    # don't replace the last report if nothing was done
+    if report.packages:
+        report.write()
+    if pathexists(os.path.join(venvdir, BUILDING_FILE)):
+        os.remove(os.path.join(venvdir, BUILDING_FILE))
+    return not [p for p in installers if p.returncode]
+
+
+def _store_dir(cfg):
+    """The venv store directory, if there is one.
+
+    The VEH_STORE environment variable overrides the store option in
+    the [veh] section.
+    """
+    storedir = os.environ.get("VEH_STORE") or _cfg_get(cfg, 'veh', 'store')
+    if storedir:
+        return expanduser(storedir)
+    return None
 
-            # Some things that you can specify about pip with veh config
-            if (cfg.has_option('pip', 'always-upgrade')
-                and cfg.getboolean('pip', 'always-upgrade')):
-                ## FIXME we've turned this off now we're using pip inside the venv
-                #cmd += ' --upgrade'
-                pass
 
-            if cfg.has_option("pip", "download-cache"):
-                cachedir = expanduser(cfg.get("pip", "download-cache"))
-                try:
-                    if not pathexists(cachedir):
-                        os.mkdir(cachedir)
-                except:
-                    print >>sys.stderr, "%s does not exist but cannot be created" % cachedir
-                else:
-                    cmd += " --download-cache=%s" % cachedir
+def _clone_strategy(cfg):
+    """How venvs are cloned, the clone-strategy in the [veh] section.
+
+    Defaults to reflink, which shares file data with the original venv
+    copy on write where the filesystem can and copies where it can't.
+    link, which hardlinks files, has to be asked for: a file changed in
+    place in one venv changes in the other too.
+    """
+    return _cfg_get(cfg, 'veh', 'clone-strategy', 'reflink')
+
+
+def _venv_from_store(repo, cfg):
+    """Make the repo's venv by cloning a matching one from the store.
+
+    Returns the new venv, which is not marked active, or None if the
+    store couldn't supply one.
+    """
+    storedir = _store_dir(cfg)
+    if not storedir:
+        return None
+    key = config_key(cfg)
+    if not store.lookup(storedir, key):
+        return None
+    newvenv = _new_venv_path(repo)
+    try:
+        store.materialize(storedir, key, newvenv, _clone_strategy(cfg))
+    except Exception, e:
+        if os.path.exists(newvenv):
+            _rm_r(newvenv)
+        print >>sys.stderr, "cloning %s from the venv store failed: %s" % (key, e)
+        return None
+    write_startup_rc(newvenv)
+    return newvenv
+
+
+def build_venv(repo, cfg, require_success=False):
+    """Build a new venv for the repo and make it the active one.
+
+    The caller must hold the build lock.
+
+    The new venv is built alongside whatever venv is currently active,
+    which stays active until the new one is finished.
+
+    If a venv store is configured a matching venv is cloned from there
+    and only if there isn't one is the venv built. Successfully built
+    venvs are published to the store.
+
+    If an earlier build of the same config was interrupted it is
+    resumed rather than starting a new venv.
+
+    With dedupe-after-build in the [veh] section the repo's venvs are
+    deduped once the new one is active.
+
+    With require_success a venv where any package failed to install is
+    not made active, it is trashed and None is returned.
+    """
+    venvdir = _venv_from_store(repo, cfg)
+    if not venvdir:
+        venvdir = _resumable_venv(repo, cfg)
+        if venvdir:
+            print >>sys.stderr, "resuming the interrupted build of %s" % venvdir
+        else:
+            venvdir = make_venv(repo, activate=False, cfg=cfg)
+        ok = fill_venv(repo, cfg=cfg, venvdir=venvdir)
+        if not ok and require_success:
+            _trash(repo, venvdir)
+            return None
+        storedir = _store_dir(cfg)
+        if ok and storedir:
+            store.publish(storedir, config_key(cfg), venvdir)
+    _mark_venv_active(repo, venvdir)
+    if _cfg_getboolean(cfg, 'veh', 'dedupe-after-build'):
+        dedupe_venvs(repo, locked=repo)
+    return venvdir
+
+
+def rebuild_venv(repo, cfg):
+    """Build a new venv for the repo, as veh rebuild does.
+
+    The active venv stays active unless the new one builds without any
+    failures. Returns the new venv or None if it failed.
+    """
+    with _build_lock(repo):
+        active = _get_active_venv(repo)
+        newvenv = build_venv(repo, cfg, require_success=bool(active))
+        if not newvenv:
+            return None
+        if active and _cfg_getboolean(cfg, 'veh', 'delete-on-rebuild'):
+            _trash(repo, active)
+        apply_retention(repo, cfg)
+    return newvenv
+
+
+def refresh_venv(repo, cfg):
+    """Bring the repo's venv up to date with the cfg, as veh refresh does.
 
-            pip_command = cmd + " " + package_name
-            pip = _venvsh(repo, venvdir, pip_command)
+    Returns True if every package installed.
+    """
+    with _build_lock(repo):
+        return fill_venv(repo, cfg=cfg)
+
+
+def clone_venv(repo, src, cfg=None):
+    """Clone the venv src into a new venv of the repo and make it active.
+
+    With a cfg its clone-strategy is used and the retention policy is
+    applied afterwards. Returns the new venv.
+    """
+    strategy = 'reflink'
+    if cfg is not None:
+        strategy = _clone_strategy(cfg)
+    newvenv = _new_venv_path(repo)
+    try:
+        clone.clone_virtualenv(src, newvenv, strategy)
+    except:
+        if os.path.exists(newvenv):
+            _rm_r(newvenv)
+        raise
+
+    # Now rewrite the startup rc file
+    write_startup_rc(newvenv)
+
+    # ... and finally mark it as the active one
+    with _build_lock(repo):
+        _mark_venv_active(repo, newvenv)
+        if cfg is not None:
+            apply_retention(repo, cfg)
+    return newvenv
+
+
+def replace_venv(repo, src, cfg):
+    """Clone the venv src into the repo in place of a rebuild.
+
+    As with a rebuild the old venv is deleted if the [veh] section has
+    delete-on-rebuild. Returns the new venv.
+    """
+    old = active_venv(repo)
+    newvenv = clone_venv(repo, src, cfg)
+    if old and _cfg_getboolean(cfg, 'veh', 'delete-on-rebuild'):
+        with _build_lock(repo):
+            _trash(repo, old)
+    return newvenv
 
 
 def venv(repo, cfg=None):
-    """Make the repos venv"""
+    """Make the repos venv
+
+    If several processes need to build the venv at once one of them
+    builds it and the others wait for it.
+
+    If the active venv was left building by an interrupted refresh the
+    build is resumed, unless the config has changed since, when the
+    half built venv is thrown away and a new one built.
+    """
 
     venvdir = _get_active_venv(repo)
-    if not venvdir or not pathexists(venvdir):
-        fill_venv(repo, cfg=cfg)
-        venvdir = _get_active_venv(repo)
+    if not _venv_ready(venvdir):
+        with _build_lock(repo):
+            # someone else might have built it while we waited
+            venvdir = _get_active_venv(repo)
+            if not venvdir or not pathexists(venvdir):
+                if cfg is None:
+                    cfg = get_config(repo)
+                venvdir = build_venv(repo, cfg)
+            elif _is_building(venvdir):
+                if cfg is None:
+                    cfg = get_config(repo)
+                if _building_key(venvdir) == config_key(cfg):
+                    print >>sys.stderr, "resuming the interrupted build of %s" % venvdir
+                    fill_venv(repo, cfg=cfg, venvdir=venvdir)
+                else:
+                    print >>sys.stderr, "the config changed since %s was left half built" % venvdir
+                    _clear_active(repo)
+                    _trash(repo, venvdir)
+                    venvdir = build_venv(repo, cfg)
     return venvdir
 
 
@@ -402,6 +1704,51 @@ CFG_TEMPLATE = """[packages]
 #  the following options controls whether the previously active virtualenv
 #  is deleted during rebuild or not:
 #   delete-on-rebuild = true
+#
+#  packages are installed with one pip run each by default, this installs
+#  all the pip packages with a single pip run instead:
+#   install-mode = batch
+#
+#  built virtualenvs can be kept in a store shared by all repositories
+#  and cloned from there when the same packages are needed again
+#  (the VEH_STORE environment variable overrides this):
+#   store = ~/.veh/store
+#
+#  cloning a virtualenv (from the store or with veh clone) shares file
+#  data with the original using copy on write clones where the
+#  filesystem supports them and copies otherwise, this makes cloning
+#  always do full copies instead:
+#   clone-strategy = copy
+#  and this hardlinks files, which is quicker still but a file changed
+#  in place in one virtualenv changes in the others too:
+#   clone-strategy = link
+#
+#  after rebuild and clone inactive virtualenvs are deleted, least
+#  recently active first, to keep to any of these limits:
+#   keep-venvs = 2
+#   max-venv-age = 30
+#   max-venvs-size = 2G
+#
+#  a pool of empty virtualenvs can be kept ready so making a virtualenv
+#  doesn't have to wait for virtualenv:
+#   spare-venvs = 2
+#
+#  virtualenvs are made from a seed virtualenv kept in ~/.veh/seed (or
+#  VEH_SEED), which is much quicker than running virtualenv each time,
+#  this always runs virtualenv instead:
+#   create = virtualenv
+#
+#  virtualenvs are made with the python virtualenv runs with, this makes
+#  them with another python:
+#   python = python2.6
+#
+#  the repositories of vc packages (hg+ and git+ urls) can be mirrored in
+#  a cache directory, so installs only pull what's new:
+#   vcs-cache = ~/.veh/vcs
+#
+#  identical files in the virtualenvs can be hardlinked together after
+#  every build, like veh dedupe does:
+#   dedupe-after-build = true
 
 
 [pip]
@@ -410,6 +1757,14 @@ CFG_TEMPLATE = """[packages]
 #   supply the --upgrade option to pip when building the virtualenv
 #   download-cache = DIRECTORY
 #   specifies a directory to use for pip's download cache
+#   wheelhouse = DIRECTORY
+#   build packages into wheels kept in DIRECTORY and install from there
+#   prefetch = 4
+#   fetch the packages into the download-cache, 4 at a time, while
+#   the installs go on (needs pip 8 or later, pip is then not given
+#   --download-cache)
+#   index-url = URL
+#   use the package index at URL, which can be a file:// directory
 
 # End
 """
@@ -482,7 +1837,8 @@ class VehCmd(SysArgsCmd):
         from os import getcwd
         foundroot = self._findroot()
         root = self.opts.get("root") or foundroot
-        return realpath(expanduser(root))
+        root = realpath(expanduser(root))
+        return root
 
     def do_install(self, arg):
         """Install a virtualenv for the repository.
@@ -500,21 +1856,45 @@ Opens VISUAL or EDITOR or /usr/bin/edit on your repositorys config file.
 
     def do_check(self, arg):
         """Report whether the repository has an associated veh.
+
+A virtualenv that is still being built, or whose build was
+interrupted, doesn't count.
         """
         root = self._getroot()
-        vehenv = _get_active_venv(root)
-        if vehenv and pathexists(vehenv):
+        if venv_status(root) == "ready":
             print root
         else:
             return 1
 
-    def do_lspackages(self, arg):
-        """List the packages specified in the veh config"""
+    def do_lspackages(self, revisions):
+        """List the packages specified in the veh config
+
+With revisions or tags lists the packages in the veh config at each of
+them, each line starting with the revision:
+
+  veh lspackages release_20110201 release_20110301 tip
+"""
 
         root = self._getroot()
-        cfg = get_config(root)
-        for p in cfg.items("packages"):
-            print "%s %s" % p
+        if not revisions:
+            cfg = get_config(root)
+            for p in cfg.items("packages"):
+                print "%s %s" % p
+            return
+        for rev, cfg in get_configs(root, revisions):
+            for p in cfg.items("packages"):
+                print "%s %s %s" % ((rev,) + p)
+
+    def do_lsinstalled(self, arg):
+        """List the packages installed in the active virtualenv"""
+
+        root = self._getroot()
+        active = _get_active_venv(root)
+        if not active:
+            return 1
+        installed = inventory.installed(active)
+        for name in sorted(installed, key=inventory.normalize_name):
+            print "%s %s" % (name, installed[name])
 
     def do_active(self, arg):
         """Is the virtualenv active? print the path if it is."""
@@ -528,30 +1908,42 @@ Opens VISUAL or EDITOR or /usr/bin/edit on your repositorys config file.
             return 1
 
     def do_clear(self, arg):
-        """Blow away the virtualenv(s)."""
+        """Blow away the virtualenv(s).
+
+The virtualenvs are moved to the trash straight away and deleted in
+the background."""
         root = self._getroot()
-        # delete the dir
-        _popencmd(["rm", "-rf", os.path.join(root, VENV_DIR)])
+        basepth = os.path.join(root, VENV_DIR)
+        if not os.path.exists(basepth):
+            return
+        with _build_lock(root):
+            _clear_active(root)
+            for name in os.listdir(basepth):
+                if name in [TRASH_DIR, LOCKFILE, REAPLOCK]:
+                    continue
+                path = os.path.join(basepth, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    _trash(root, path)
+                else:
+                    os.remove(path)
+            # finish off any deleting that was interrupted
+            if _trash_pending(root):
+                _start_reaper(root)
 
     def do_rebuild(self, arg):
         """Rebuild the virtualenv.
 
 This builds a new virtualenv from scratch. The old virtualenv is not
-affected at all."""
+affected at all: it stays active while the new one is built and the new
+one only becomes active once every package has been installed.
+
+If the [veh] section has delete-on-rebuild the old virtualenv is
+deleted once the new one is active."""
         root = self._getroot()
         cfg = get_config(root, *arg[:1])
-        active = _get_active_venv(root)
-        if active:
-            _clear_active(root)
-            deleteold = False  # default value
-            try:
-                deleteold = cfg.getboolean('veh', 'delete-on-rebuild')
-            except (NoSectionError, NoOptionError), e:
-                pass
-            if deleteold:
-                _rm_r(active)
-        # Rebuild it.
-        venv(root, cfg)
+        if not rebuild_venv(root, cfg):
+            print >>sys.stderr, "rebuild failed, %s is still active" % _get_active_venv(root)
+            return 1
 
     def do_refresh(self, revision):
         """Refresh all packages, optionally from a specific version or tag.
@@ -559,8 +1951,9 @@ affected at all."""
 Packages that don't exist in the currently active virtual env are
 retrieved. 
 
-Packages that differ in version to the current install are also
-reinstalled.
+Packages whose config entry differs from the one they were installed
+with are upgraded and packages no longer in the config are
+uninstalled. Packages that haven't changed are not touched.
 
 With an argyment, reads the veh.conf from the revision or tag specified, thus:
 
@@ -576,7 +1969,182 @@ No revision means the working copy will be read for the veh.conf
 """
         root = self._getroot()
         cfg = get_config(root, *revision[:1])
-        fill_venv(root, cfg=cfg)
+        refresh_venv(root, cfg)
+
+    def do_lock(self, arg):
+        """Write the lock file pinning the active virtualenv's packages.
+
+The virtualenv is brought up to date with the veh config, resolving the
+packages as usual, and then every package installed in it is pinned,
+with the hash of its artifact, in .veh.lock next to the config. vc
+references, urls and paths in the config are locked as they are.
+
+Nothing is locked if any other package can't be downloaded from the
+package index, a develop install say.
+
+While the config hasn't changed since the lock was made virtualenvs
+are built from the lock, with no resolution and no dependency walking.
+"""
+        root = self._getroot()
+        cfg = get_config(root)
+        with _build_lock(root):
+            if not fill_venv(root, cfg=cfg, use_lock=False):
+                print >>sys.stderr, "not locking, some packages failed to install"
+                return 1
+            unhashed = lock_venv(root, cfg, _get_active_venv(root))
+        if unhashed:
+            for name, version in unhashed:
+                print >>sys.stderr, "could not download %s==%s" % (name, version)
+            print >>sys.stderr, "not locking, some packages are not on the package index"
+            return 1
+
+    def do_wheelhouse(self, arg):
+        """Manage the wheelhouse of built packages.
+
+  veh wheelhouse fill
+
+builds all the packages in the veh config into the wheelhouse.
+
+  veh wheelhouse prune [DAYS]
+
+removes wheelhouse entries that haven't been used in DAYS days
+(default 30).
+
+  veh wheelhouse ls
+
+lists the wheelhouse entries.
+
+The wheelhouse directory is the wheelhouse option in the [pip]
+section of the veh config.
+"""
+        root = self._getroot()
+        cfg = get_config(root)
+        wheelhouse_dir = _wheelhouse_dir(cfg)
+        if not wheelhouse_dir:
+            print >>sys.stderr, "no wheelhouse in the [pip] section of the veh config"
+            return 1
+        action = arg[0] if arg else "ls"
+        if action == "fill":
+            vmdir = venv(root, cfg)
+            package_names = [p[1] or p[0] for p in cfg.items("packages")
+                             if not _is_easy_install(p)]
+            built = fill_wheelhouse(root, vmdir, wheelhouse_dir, package_names)
+            if len(built) != len(package_names):
+                return 1
+        elif action == "prune":
+            days = int(arg[1]) if arg[1:] else 30
+            for entry in wheelhouse.prune(wheelhouse_dir, days):
+                sys.stdout.write("removing %s\n" % entry)
+        elif action == "ls":
+            for abi, spec, entry, lastused in wheelhouse.entries(wheelhouse_dir):
+                sys.stdout.write("%s %s\n" % (abi, spec or "(incomplete) %s" % entry))
+        else:
+            print >>sys.stderr, "unknown wheelhouse command %s" % action
+            return 1
+
+    def do_prebuild(self, revision):
+        """Build the virtualenv for a revision into the venv store.
+
+The virtualenv is built for the veh.conf at the revision or tag (or
+the working copy if there's none) and put in the venv store, but
+nothing is made active. A later rebuild, or first use, with the same
+config is then just a clone from the store.
+
+The virtualenv is built in a temporary directory in the store, so it
+doesn't get in the way of the repository's own virtualenvs.
+
+This needs a venv store, see the store option in the [veh] section.
+"""
+        root = self._getroot()
+        cfg = get_config(root, *revision[:1])
+        storedir = _store_dir(cfg)
+        if not storedir:
+            print >>sys.stderr, "prebuilding needs a venv store"
+            return 1
+        key = config_key(cfg)
+        if store.lookup(storedir, key):
+            return
+        # Build it outside the repo's venvs, where nothing else touches it
+        if not os.path.exists(storedir):
+            os.makedirs(storedir)
+        builddir = tempfile.mkdtemp(prefix=".prebuild-", dir=storedir)
+        try:
+            venvdir = os.path.join(builddir, "venv")
+            _create_venv(venvdir, cfg)
+            if not fill_venv(root, cfg=cfg, venvdir=venvdir):
+                return 1
+            store.publish(storedir, key, venvdir)
+        finally:
+            _rm_r(builddir)
+
+    def do_report(self, arg):
+        """Summarize the last build of the active virtualenv.
+
+Shows the slowest installs and any that failed. With a number shows
+that many of the slowest (default 10):
+
+  veh report 20
+"""
+        root = self._getroot()
+        active = _get_active_venv(root)
+        report = active and read_report(active)
+        if not report:
+            print >>sys.stderr, "no build report for the active virtualenv"
+            return 1
+        count = int(arg[0]) if arg else 10
+        packages = report["packages"]
+        print "build of %s took %.1fs" % (active, report["seconds"])
+        print "slowest:"
+        for p in sorted(packages, key=lambda p: p["seconds"], reverse=True)[:count]:
+            print "  %8.1fs %10d bytes  %s (%s)" % (
+                p["seconds"], p["bytes"], p["package"], p["installer"])
+        fetches = report.get("fetches")
+        if fetches:
+            print "slowest prefetches:"
+            for f in sorted(fetches, key=lambda f: f["seconds"], reverse=True)[:count]:
+                print "  %8.1fs  %s%s" % (
+                    f["seconds"], f["package"], " (failed)" if f["status"] else "")
+        failed = [p for p in packages if p["status"]]
+        if failed:
+            print "failed:"
+            for p in failed:
+                print "  %s (%s exited %s)" % (p["package"], p["installer"], p["status"])
+            return 1
+
+    def do_batch(self, arg):
+        """Rebuild, refresh or check the virtualenvs of many repositories.
+
+  veh batch rebuild [-j N] repositorydir...
+  veh batch refresh [-j N] repositorydir...
+  veh batch check repositorydir...
+
+The configs of all the repositories are read first. Each distinct
+config is built once, up to N (default 4) at a time in separate
+processes, and repositories with the same config as one that was built
+get a clone of its virtualenv. Refreshing only clones into repositories
+that have no virtualenv, the rest are refreshed as usual. What each
+repository's build prints is printed together once it has finished. A
+summary of how long each took is printed at the end.
+"""
+        from veh import batch
+        if not arg or arg[0] not in batch.ACTIONS:
+            print >>sys.stderr, "batch needs one of %s" % ", ".join(batch.ACTIONS)
+            return 1
+        action = arg[0]
+        repos = []
+        for a in arg[1:]:
+            repo = os.path.realpath(expanduser(a))
+            if repo not in repos:
+                repos.append(repo)
+        if not repos:
+            print >>sys.stderr, "no repositories to %s" % action
+            return 1
+        if action == "check":
+            failed = batch.check(repos)
+        else:
+            failed = batch.run(action, repos, self.opts.get("jobs") or batch.WORKERS)
+        if failed:
+            return 1
 
     def do_cat(self, arg):
         """Cat the veh config file"""
@@ -611,11 +2179,72 @@ will NOT run ipython in the virtualenv.
         vmdir = venv(root)
         _venvsh(root, vmdir, " ".join(shellcmd), exec_=True)
 
+    def do_exec(self, command):
+        """Run a command inside the venv'd repository without a shell.
+
+First checks that the virtualenv for the repository has been built and
+builds if necessary.
+
+  veh exec -- start_server --port 8000
+
+runs start_server, found on the virtualenv's PATH, directly with the
+virtualenv's environment. No shell or shell startup files are run so
+this works whatever SHELL is.
+"""
+        if not command:
+            print >>sys.stderr, "no command to exec"
+            return 1
+        root = self._getroot()
+        vmdir = venv(root)
+        env = _venv_environ(root, vmdir)
+        if _verbose:
+            print >>sys.stderr, "execing %s inside the venv %s in %s" % (command, vmdir, root)
+        os.execvpe(command[0], command, env)
+
     def do_noop(self, arg):
         """No-op. Just checks the virtualenv.
         """
         venv(self._getroot())
 
+    def do_daemon(self, arg):
+        """Run the veh daemon.
+
+The daemon answers check, active, lspackages and root queries from the
+vehc client from a cache, without starting python each time.
+
+It listens on the unix socket VEH_SOCKET, or ~/.veh/daemon.sock, and
+runs until it's killed.
+"""
+        from veh import daemon
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            pass
+
+    def do_dedupe(self, arg):
+        """Hardlink identical files across virtualenvs.
+
+Files that are the same in several of the repository's virtualenvs are
+replaced with hardlinks to one copy. With a directory the virtualenvs
+of each repository under it are deduped:
+
+  veh dedupe ~/src
+
+Files are only linked between the virtualenvs of one repository, never
+between repositories. Files that veh, virtualenv cloning or python
+might change in place, like .pyc files, are never linked. The hashes of the files are kept so the next dedupe only has
+to hash new files.
+
+Set dedupe-after-build in the [veh] section of the config to dedupe
+after every build.
+"""
+        if arg:
+            root = os.path.realpath(expanduser(arg[0]))
+        else:
+            root = self._getroot()
+        linked, saved = dedupe_venvs(root)
+        print "linked %d files, saving %d bytes" % (linked, saved)
+
     def do_cleanup(self, arg):
         """Cleanup inactive virtual environments"""
         root = self._getroot()
@@ -637,21 +2266,16 @@ will NOT run ipython in the virtualenv.
         if not active:
             print >> sys.stdout, "no active venv to clone"
             sys.exit(1)
-        newvenv = _new_venv_path(root)
         try:
-            clone.clone_virtualenv(active, newvenv)
+            cfg = get_config(root)
+        except Exception, e:
+            cfg = None
+        try:
+            clone_venv(root, active, cfg)
         except Exception, e:
-            if os.path.exists(newvenv):
-                _rm_r(newvenv)
             print >> sys.stdout, "cloning active virtualenv failed"
             sys.exit(1)
 
-        # Now rewrite the startup rc file
-        write_startup_rc(newvenv)
-
-        # ... and finally mark it as the active one
-        _mark_venv_active(root, newvenv)
-
 
 def main():
     from optparse import OptionParser
@@ -669,6 +2293,13 @@ def main():
         dest="verbose",
         help="verbose flag"
         )
+    p.add_option(
+        "-j",
+        "--jobs",
+        type="int",
+        dest="jobs",
+        help="how many repositories veh batch builds at once"
+        )
     p.add_option(
         "-V",
         "--version",
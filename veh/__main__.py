@@ -0,0 +1,4 @@
+"""Run veh with python -m veh."""
+from veh import main
+
+main()
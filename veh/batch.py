@@ -0,0 +1,211 @@
+"""Rebuild, refresh or check the virtualenvs of many repositories at once.
+
+Every repository's config is loaded up front and the repositories are
+grouped by veh.config_key, so repositories with identical configs
+are in one group. The first repository of each group is built, the
+groups in parallel in a pool of worker processes, and the rest of the
+group clone its venv with veh.clone instead of building their own.
+
+Refreshing only clones into the repositories that have no venv, the
+ones that have a venv are refreshed as usual, which does nothing if
+their venv is already up to date.
+
+What each repository's build prints is kept until it has finished and
+then printed in one piece, so the repositories being built at once
+don't interleave. A summary of what was done to each repository and how
+long it took is printed at the end.
+"""
+from __future__ import with_statement
+import os
+import sys
+import tempfile
+import time
+
+import veh
+
+ACTIONS = ['rebuild', 'refresh', 'check']
+WORKERS = 4
+
+
+def load(repos):
+    """Load the config of each repo.
+
+    Returns (configs, errors) where configs is a list of (repo, cfg)
+    and errors is a list of (repo, error) for the repos whose config
+    couldn't be read.
+    """
+    configs = []
+    errors = []
+    for repo in repos:
+        try:
+            configs.append((repo, veh.get_config(repo)))
+        except Exception, e:
+            errors.append((repo, str(e) or e.__class__.__name__))
+    return configs, errors
+
+
+def group(configs):
+    """Group the (repo, cfg) configs with identical configs.
+
+    Returns a list of groups, each a list of (repo, cfg), in the order
+    the first of each was in configs.
+    """
+    groups = {}
+    order = []
+    for repo, cfg in configs:
+        key = veh.config_key(cfg)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((repo, cfg))
+    return [groups[key] for key in order]
+
+
+def _captured(function, *args):
+    """Call function with args, capturing what it and its subprocesses
+    print. Returns (result, output)."""
+    capture = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    try:
+        os.dup2(capture.fileno(), 1)
+        os.dup2(capture.fileno(), 2)
+        try:
+            result = function(*args)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+    finally:
+        os.close(saved[0])
+        os.close(saved[1])
+    capture.seek(0)
+    return result, capture.read()
+
+
+def _build_repo(action, repo):
+    """Rebuild or refresh the repo's venv, returns (ok, error)."""
+    try:
+        cfg = veh.get_config(repo)
+        if action == 'rebuild':
+            ok = veh.rebuild_venv(repo, cfg) is not None
+        else:
+            ok = veh.refresh_venv(repo, cfg)
+        return ok, not ok and "some packages failed to install" or None
+    except Exception, e:
+        return False, str(e) or e.__class__.__name__
+
+
+def _build(args):
+    """Build one repo's venv in a worker.
+
+    Returns (repo, ok, seconds, error, output) where output is what the
+    build printed.
+    """
+    action, repo = args
+    started = time.time()
+    (ok, error), output = _captured(_build_repo, action, repo)
+    return repo, ok, time.time() - started, error, output
+
+
+def _follow_repo(action, source, repo):
+    """Give repo the same venv as source, returns (what, error)."""
+    try:
+        cfg = veh.get_config(repo)
+        if action == 'refresh' and veh.venv_status(repo) == "ready":
+            ok = veh.refresh_venv(repo, cfg)
+            error = not ok and "some packages failed to install" or None
+            return ok and action or "failed", error
+        veh.replace_venv(repo, veh.active_venv(source), cfg)
+        return "cloned", None
+    except Exception, e:
+        return "failed", str(e) or e.__class__.__name__
+
+
+def _follow(args):
+    """Give repo the same venv as source in a worker.
+
+    Returns (repo, what, seconds, error, output) where what is "cloned"
+    if source's venv was cloned, action if repo was refreshed or
+    "failed", and output is what was printed doing it.
+    """
+    action, source, repo = args
+    started = time.time()
+    (what, error), output = _captured(_follow_repo, action, source, repo)
+    return repo, what, time.time() - started, error, output
+
+
+def _show(out, repo, output):
+    """Print the output of a repo's build, if it printed anything."""
+    if output:
+        print >>out, "--- %s" % repo
+        out.write(output)
+        if not output.endswith("\n"):
+            out.write("\n")
+        out.flush()
+
+
+def check(repos, out=sys.stdout):
+    """Print whether each repo's venv is ready, returns how many aren't."""
+    notready = 0
+    for repo in repos:
+        status = veh.venv_status(repo)
+        if status != "ready":
+            notready += 1
+        print >>out, "%-8s %s" % (status, repo)
+    return notready
+
+
+def run(action, repos, workers=WORKERS, out=sys.stdout):
+    """Rebuild or refresh the repos' venvs, returns how many failed."""
+    started = time.time()
+    configs, errors = load(repos)
+    groups = group(configs)
+
+    built = []
+    followed = []
+    if groups:
+        from multiprocessing import Pool
+        pool = Pool(min(workers, len(groups)))
+        try:
+            # print each repo's output as soon as it's done
+            for result in pool.imap_unordered(_build, [(action, g[0][0]) for g in groups]):
+                _show(out, result[0], result[-1])
+                built.append(result[:-1])
+            succeeded = set(repo for repo, ok, seconds, error in built if ok)
+            followers = [(action, g[0][0], repo) for g in groups for repo, cfg in g[1:]
+                         if g[0][0] in succeeded]
+            for result in pool.imap_unordered(_follow, followers):
+                _show(out, result[0], result[-1])
+                followed.append(result[:-1])
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - started
+
+    # repo: (what happened, seconds, error)
+    results = dict((repo, ("failed", 0.0, error)) for repo, error in errors)
+    for repo, ok, seconds, error in built:
+        results[repo] = (ok and action or "failed", seconds, error)
+    for repo, what, seconds, error in followed:
+        results[repo] = (what, seconds, error)
+    for g in groups:
+        for repo, cfg in g[1:]:
+            if repo not in results:
+                results[repo] = ("failed", 0.0, "%s failed to build" % g[0][0])
+
+    failed = 0
+    for repo in repos:
+        what, seconds, error = results[repo]
+        if what == "failed":
+            failed += 1
+        print >>out, "%8.1fs %-8s %s%s" % (
+            seconds, what, repo, error and " (%s)" % error or "")
+    print >>out, "%d repositories, %d configs: %d built, %d cloned, %d failed in %.1fs" % (
+        len(repos), len(groups), len([b for b in built if b[1]]),
+        len([f for f in followed if f[1] == "cloned"]), failed, elapsed)
+    return failed
+
+# End
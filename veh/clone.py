@@ -13,7 +13,9 @@ existing virtualenv.
 
 It performs the following:
 
-- copies sys.argv[1] dir to sys.argv[2]
+- copies sys.argv[1] dir to sys.argv[2], either byte for byte or, with
+  the reflink and link strategies, by sharing file data with the
+  original (see _copytree).
 - updates the hardcoded VIRTUAL_ENV variable in the activate script to the
   new repo location. (--relocatable doesn't touch this)
 - updates the shebangs of the various scripts in bin to the new python if
@@ -25,10 +27,12 @@ It performs the following:
 - checks sys.path of the cloned virtualenv and if any of the paths are from
   the old environment it finds any .pth or .egg-link files within sys.path
   located in the new environment and makes sure any absolute paths to the
-  old environment are updated to the new environment.
+  old environment are updated to the new environment. sys.path is worked
+  out from the virtualenv's layout rather than by running its python.
 
 - finally it double checks sys.path again and will fail if there are still
-  paths from the old environment present.
+  paths from the old environment present. This check can optionally run
+  the cloned python as well.
 
 """
 from __future__ import with_statement
@@ -37,6 +41,7 @@ import os
 import shutil
 import subprocess
 import sys
+import tempfile
 
 version_info = (0, 1, 1)
 __version__ = '.'.join(map(str, version_info))
@@ -45,6 +50,12 @@ __version__ = '.'.join(map(str, version_info))
 logger = logging.getLogger()
 logging.basicConfig(level=logging.WARNING)
 
+# Shebang lines longer than this aren't ones we'd rewrite
+MAX_SHEBANG = 4096
+
+# How many fixups run at once by default
+WORKERS = 4
+
 
 def _dirmatch(path, matchwith):
     """Check if path is within matchwith's tree.
@@ -83,105 +94,379 @@ def _virtualenv_sys(venv_path):
     return lines[0], filter(bool, lines[1:])
 
 
-def clone_virtualenv(src_dir, dst_dir):
+def _pth_paths(sitedir):
+    """The paths the .pth files in sitedir add to sys.path.
+
+    This follows site.addsitedir: lines are paths relative to sitedir
+    and only added if they exist, comments and import lines are
+    ignored.
+    """
+    paths = []
+    try:
+        names = sorted(os.listdir(sitedir))
+    except OSError, e:
+        return paths
+    for name in names:
+        if not name.endswith('.pth'):
+            continue
+        with open(os.path.join(sitedir, name), 'rb') as f:
+            for line in f:
+                line = line.rstrip()
+                if not line or line.startswith('#') or line.startswith('import '):
+                    continue
+                path = os.path.normpath(os.path.join(sitedir, line))
+                if os.path.exists(path) and path not in paths:
+                    paths.append(path)
+    return paths
+
+
+def _virtualenv_sys_static(venv_path):
+    """obtain version and path info from a virtualenv without running it.
+
+    The version comes from the lib/pythonX.Y directory and sys.path is
+    worked out the way the virtualenv's site.py would: the venv's lib
+    directory, the original install's lib directories (from
+    orig-prefix.txt), site-packages and whatever the .pth files in
+    site-packages add.
+    """
+    libdir = os.path.join(venv_path, 'lib')
+    versions = sorted(d[len('python'):] for d in os.listdir(libdir)
+                      if d.startswith('python'))
+    if not versions:
+        raise Exception('no python lib directory in %s' % venv_path)
+    version = versions[-1]
+    pylib = os.path.join(libdir, 'python%s' % version)
+    sys_path = [pylib]
+
+    orig_prefix_file = os.path.join(pylib, 'orig-prefix.txt')
+    if os.path.exists(orig_prefix_file):
+        with open(orig_prefix_file, 'rb') as f:
+            orig_prefix = f.read().strip()
+        orig_lib = os.path.join(orig_prefix, 'lib', 'python%s' % version)
+        sys_path += [orig_lib, os.path.join(orig_lib, 'lib-dynload')]
+
+    sitedirs = [os.path.join(pylib, 'site-packages')]
+    # debian and ubuntu pythons use local/lib as well
+    local_site = os.path.join(venv_path, 'local', 'lib', 'python%s' % version, 'site-packages')
+    if os.path.isdir(local_site) and not os.path.islink(local_site):
+        sitedirs.append(local_site)
+    for sitedir in sitedirs:
+        sys_path.append(sitedir)
+        sys_path += _pth_paths(sitedir)
+    return version, sys_path
+
+
+# ioctl request to share a file's data with another file (linux/fs.h)
+FICLONE = 0x40049409
+
+STRATEGIES = ['copy', 'reflink', 'link']
+
+
+def _rewritable(relpath):
+    """Might the fixups, or veh, rewrite the file at relpath in place?
+
+    relpath is relative to the virtualenv root. These files must always
+    be real copies because a hardlinked copy would change the original
+    as well. That includes compiled .pyc and .pyo files, which python
+    rewrites in place when it compiles the source again.
+    """
+    dirname, filename = os.path.split(relpath)
+    return (not dirname
+            or dirname == 'bin'
+            or filename.endswith('.pth')
+            or filename.endswith('.egg-link')
+            or filename.endswith('.pyc')
+            or filename.endswith('.pyo'))
+
+
+def _reflink(src, dst):
+    """Make dst a copy on write clone of src."""
+    import fcntl
+    with open(src, 'rb') as srcf:
+        with open(dst, 'wb') as dstf:
+            fcntl.ioctl(dstf.fileno(), FICLONE, srcf.fileno())
+    shutil.copystat(src, dst)
+
+
+def _copytree(src_dir, dst_dir, strategy='copy'):
+    """Copy the src_dir virtualenv tree to dst_dir.
+
+    With the copy strategy this is shutil.copytree.
+
+    With the reflink strategy each file is cloned copy on write where
+    the filesystem supports it and copied otherwise.
+
+    The link strategy is like reflink but files that the fixups won't
+    rewrite are hardlinked rather than copied if they can't be cloned.
+    """
+    if strategy not in STRATEGIES:
+        raise Exception('unknown clone strategy %r' % strategy)
+    if strategy == 'copy':
+        shutil.copytree(src_dir, dst_dir, symlinks=True)
+        return
+
+    can_reflink = [True]
+    can_link = [strategy == 'link']
+
+    def copy_file(src, dst, relpath):
+        if can_reflink[0]:
+            try:
+                _reflink(src, dst)
+                return
+            except (IOError, OSError, ImportError), e:
+                # Not supported here, don't try again for this tree
+                can_reflink[0] = False
+                if os.path.exists(dst):
+                    os.remove(dst)
+        if can_link[0] and not _rewritable(relpath):
+            try:
+                os.link(src, dst)
+                return
+            except OSError, e:
+                can_link[0] = False
+        shutil.copy2(src, dst)
+
+    for root, dirs, files in os.walk(src_dir):
+        reldir = os.path.relpath(root, src_dir)
+        if reldir == os.curdir:
+            reldir = ''
+        dst_root = os.path.join(dst_dir, reldir)
+        os.mkdir(dst_root)
+        shutil.copystat(root, dst_root)
+        for name in dirs[:]:
+            src = os.path.join(root, name)
+            if os.path.islink(src):
+                # os.walk doesn't descend into links so copy them here
+                os.symlink(os.readlink(src), os.path.join(dst_root, name))
+                dirs.remove(name)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(dst_root, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                copy_file(src, dst, os.path.join(reldir, name))
+
+
+def clone_virtualenv(src_dir, dst_dir, strategy='copy', verify=False,
+                     workers=WORKERS):
+    """Clone the virtualenv at src_dir to dst_dir.
+
+    strategy is how the files are copied, one of STRATEGIES; see
+    _copytree.
+
+    The cloned virtualenv's sys.path is worked out without running its
+    python. With verify the cloned python is run once at the end to
+    check its real sys.path too.
+
+    The fixups of bin/ and sys.path run with a pool of worker threads.
+    """
     if not os.path.exists(src_dir):
         raise Exception('src dir does not exist')
     if os.path.exists(dst_dir):
         raise Exception('dest dir exists')
     #sys_path = _virtualenv_syspath(src_dir)
-    shutil.copytree(src_dir, dst_dir, symlinks=True)
-    version, sys_path = _virtualenv_sys(dst_dir)
-    fixup_scripts(src_dir, dst_dir, version)
+    _copytree(src_dir, dst_dir, strategy)
+    _fixup_virtualenv(src_dir, dst_dir, verify, workers)
+
+
+def move_virtualenv(src_dir, dst_dir, verify=False, workers=WORKERS):
+    """Move the virtualenv at src_dir to dst_dir.
+
+    The virtualenv is renamed, so this only works on one filesystem,
+    and then fixed up like a clone.
+    """
+    if not os.path.exists(src_dir):
+        raise Exception('src dir does not exist')
+    if os.path.exists(dst_dir):
+        raise Exception('dest dir exists')
+    os.rename(src_dir, dst_dir)
+    _fixup_virtualenv(src_dir, dst_dir, verify, workers, moved=True)
+
+
+def _fixup_virtualenv(src_dir, dst_dir, verify=False, workers=WORKERS,
+                      moved=False):
+    """Fix the paths to src_dir in the dst_dir copy of it.
+
+    When the virtualenv was moved paths into src_dir don't exist any
+    more, so they can't turn up in the worked out sys.path, and the
+    sys.path items are always fixed.
+    """
+    version, sys_path = _virtualenv_sys_static(dst_dir)
+    fixups = _script_fixups(src_dir, dst_dir, version)
 
-    has_old = lambda s: any(i for i in s if _dirmatch(i, src_dir))
+    has_old = lambda s: [i for i in s if _dirmatch(i, src_dir)]
 
-    if has_old(sys_path):
+    if moved or has_old(sys_path):
         # only need to fix stuff in sys.path if we have old
         # paths in the sys.path of new python env. right?
-        fixup_syspath_items(sys_path, src_dir, dst_dir)
-    remaining = has_old(_virtualenv_sys(dst_dir)[1])
-    assert not remaining, _virtualenv_sys(dst_dir)
+        fixups += _syspath_fixups(sys_path, src_dir, dst_dir)
+    _run_fixups(fixups, workers)
+    remaining = has_old(_virtualenv_sys_static(dst_dir)[1])
+    if verify and not remaining:
+        remaining = has_old(_virtualenv_sys(dst_dir)[1])
+    if remaining:
+        raise Exception('old paths remain in sys.path: %s' % remaining)
+
+
+def _replace_file(filename):
+    """Open a temporary file to replace filename with.
+
+    The temporary file is in the same directory and has the same mode.
+    Call _commit_file to rename it over filename. Because the original
+    is replaced rather than written to a hardlinked original is never
+    changed.
+    """
+    dirname, basename = os.path.split(filename)
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.' % basename, dir=dirname)
+    shutil.copymode(filename, tmpname)
+    return os.fdopen(fd, 'wb'), tmpname
+
+
+def _commit_file(filename, tmpname):
+    os.rename(tmpname, filename)
+
+
+def _abort_file(tmpname):
+    os.remove(tmpname)
+
+
+def _run_fixups(fixups, workers=WORKERS):
+    """Run the (function, args) fixups, with a pool of worker threads."""
+    if workers > 1 and len(fixups) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(fixups)))
+        try:
+            results = [pool.apply_async(func, args) for func, args in fixups]
+            for result in results:
+                # get re-raises any exception from the fixup
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for func, args in fixups:
+            func(*args)
 
 
-def fixup_scripts(old_dir, new_dir, version, rewrite_env_python=False):
+def _script_fixups(old_dir, new_dir, version, rewrite_env_python=False):
+    """The fixups needed for bin/ as (function, args) tuples."""
+    fixups = []
     bin_dir = os.path.join(new_dir, 'bin')
     root, dirs, files = os.walk(bin_dir).next()
     for file_ in files:
-        if file_ == 'activate':
-            fixup_activate(os.path.join(root, file_), old_dir, new_dir)
+        filename = os.path.join(root, file_)
+        if file_ in ['activate', 'activate.csh', 'activate.fish']:
+            fixups.append((fixup_activate, (filename, old_dir, new_dir)))
         elif file_ in ['python', 'python%s' % version, 'activate_this.py']:
             continue
-        elif os.path.islink(os.path.join(root, file_)):
+        elif os.path.islink(filename):
             target = os.readlink(filename)
             if _dirmatch(target, old_dir):
-                fixup_link(filename, old_dir, new_dir)
-        elif os.path.isfile(os.path.join(root, file_)):
-            fixup_script_(root, file_, old_dir, new_dir, version,
-                rewrite_env_python=rewrite_env_python)
+                fixups.append((fixup_link, (filename, old_dir, new_dir, target)))
+        elif os.path.isfile(filename):
+            fixups.append((fixup_script_, (root, file_, old_dir, new_dir, version,
+                                           rewrite_env_python)))
+    return fixups
+
+
+def fixup_scripts(old_dir, new_dir, version, rewrite_env_python=False,
+                  workers=WORKERS):
+    _run_fixups(
+        _script_fixups(old_dir, new_dir, version, rewrite_env_python),
+        workers)
 
 
 def fixup_script_(root, file_, old_dir, new_dir, version,
                   rewrite_env_python=False):
+    """Rewrite the shebang of the script if it points at the old python.
+
+    Only the first line is read to decide, the rest of the file is
+    streamed to the rewritten copy.
+    """
     old_shebang = '#!%s/bin/python' % os.path.normcase(os.path.abspath(old_dir))
     new_shebang = '#!%s/bin/python' % os.path.normcase(os.path.abspath(new_dir))
     env_shebang = '#!/usr/bin/env python'
 
     filename = os.path.join(root, file_)
-    f = open(filename, 'rb')
-    lines = f.readlines()
-    f.close()
-
-    if not lines:
-        # warn: empty script
-        return
-
-    def rewrite_shebang(version=None):
-        logger.debug('fixing %s' % filename)
-        shebang = new_shebang
-        if version:
-            shebang = shebang + version
-        with open(filename, 'wb') as f:
-            f.write('%s\n' % shebang)
-            f.writelines(lines[1:])
-
-    bang = lines[0].strip()
-
-    if not bang.startswith('#!'):
-        return
-    elif bang == old_shebang:
-        rewrite_shebang()
-    elif (bang.startswith(old_shebang)
-          and bang[len(old_shebang):] == version):
-        rewrite_shebang(version)
-    elif rewrite_env_python and bang.startswith(env_shebang):
-        if bang == env_shebang:
+    with open(filename, 'rb') as f:
+        first = f.readline(MAX_SHEBANG)
+
+        if not first:
+            # warn: empty script
+            return
+
+        def rewrite_shebang(version=None):
+            logger.debug('fixing %s' % filename)
+            shebang = new_shebang
+            if version:
+                shebang = shebang + version
+            out, tmpname = _replace_file(filename)
+            try:
+                with out:
+                    out.write('%s\n' % shebang)
+                    shutil.copyfileobj(f, out)
+            except:
+                _abort_file(tmpname)
+                raise
+            _commit_file(filename, tmpname)
+
+        bang = first.strip()
+
+        if not bang.startswith('#!'):
+            return
+        elif bang == old_shebang:
             rewrite_shebang()
-        elif bang[len(env_shebang):] == version:
+        elif (bang.startswith(old_shebang)
+              and bang[len(old_shebang):] == version):
             rewrite_shebang(version)
-    else:
-        # can't do anything
-        return
+        elif rewrite_env_python and bang.startswith(env_shebang):
+            if bang == env_shebang:
+                rewrite_shebang()
+            elif bang[len(env_shebang):] == version:
+                rewrite_shebang(version)
+        else:
+            # can't do anything
+            return
 
 
 def fixup_activate(filename, old_dir, new_dir):
+    """Replace old_dir with new_dir in the activate script.
+
+    The script is streamed line by line and only replaced if something
+    changed.
+    """
     logger.debug('fixing %s' % filename)
-    f = open(filename, 'rb')
-    data = f.read()
-    f.close()
-    data = data.replace(old_dir, new_dir)
-    f = open(filename, 'wb')
-    f.write(data)
-    f.close()
+    has_change = False
+    out, tmpname = _replace_file(filename)
+    try:
+        with out:
+            with open(filename, 'rb') as f:
+                for line in f:
+                    if old_dir in line:
+                        line = line.replace(old_dir, new_dir)
+                        has_change = True
+                    out.write(line)
+    except:
+        _abort_file(tmpname)
+        raise
+    if has_change:
+        _commit_file(filename, tmpname)
+    else:
+        _abort_file(tmpname)
 
 
 def fixup_link(filename, old_dir, new_dir, target=None):
     logger.debug('fixing %s' % filename)
     if target is None:
         target = os.readlink(filename)
-    raise NotImplementedError()
+    os.remove(filename)
+    os.symlink(target.replace(old_dir, new_dir, 1), filename)
 
 
-def fixup_syspath_items(syspath, old_dir, new_dir):
+def _syspath_fixups(syspath, old_dir, new_dir):
+    """The fixups needed for the sys.path directories as (function, args)."""
+    fixups = []
     for path in syspath:
         if not os.path.isdir(path):
             continue
@@ -196,9 +481,14 @@ def fixup_syspath_items(syspath, old_dir, new_dir):
         for file_ in files:
             filename = os.path.join(root, file_)
             if filename.endswith('.pth'):
-                fixup_pth_file(filename, old_dir, new_dir)
+                fixups.append((fixup_pth_file, (filename, old_dir, new_dir)))
             elif filename.endswith('.egg-link'):
-                fixup_egglink_file(filename, old_dir, new_dir)
+                fixups.append((fixup_egglink_file, (filename, old_dir, new_dir)))
+    return fixups
+
+
+def fixup_syspath_items(syspath, old_dir, new_dir, workers=WORKERS):
+    _run_fixups(_syspath_fixups(syspath, old_dir, new_dir), workers)
 
 
 def fixup_pth_file(filename, old_dir, new_dir):
@@ -211,21 +501,26 @@ def fixup_pth_file(filename, old_dir, new_dir):
         if not line or line.startswith('#') or line.startswith('import '):
             continue
         elif _dirmatch(line, old_dir):
-            lines[num] = line.replace(old_dir, new_dir, 1)
+            lines[num] = '%s\n' % line.replace(old_dir, new_dir, 1)
             has_change = True
     if has_change:
-        with open(filename, 'wb') as f:
-            f.writelines(lines)
+        out, tmpname = _replace_file(filename)
+        with out:
+            out.writelines(lines)
+        _commit_file(filename, tmpname)
 
 
 def fixup_egglink_file(filename, old_dir, new_dir):
     logger.debug('fixing %s' % filename)
     with open(filename, 'rb') as f:
-        link = f.read().strip()
-    if _dirmatch(link, old_dir):
-        link = link.replace(old_dir, new_dir, 1)
-        with open(filename, 'wb') as f:
-            f.write('%s\n' % link)
+        lines = f.readlines()
+    link = lines and lines[0].strip()
+    if link and _dirmatch(link, old_dir):
+        lines[0] = '%s\n' % link.replace(old_dir, new_dir, 1)
+        out, tmpname = _replace_file(filename)
+        with out:
+            out.writelines(lines)
+        _commit_file(filename, tmpname)
 
 
 if __name__ == '__main__':
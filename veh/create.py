@@ -0,0 +1,93 @@
+"""Create virtualenvs in-process from a seed virtualenv.
+
+Running the virtualenv script starts another python and then installs
+setuptools and pip into the new virtualenv, which takes seconds. This
+does that once per interpreter, to make a seed virtualenv kept in a
+per-user seed directory, and lays out every later virtualenv from the
+seed in-process with veh.clone: the interpreter links, lib, the
+activate scripts and the installers all come from the seed and the
+paths in them are fixed for the new location.
+
+A seed is only used once it has been completely made, which is marked
+by the COMPLETE file inside it. The process making a seed holds an
+flock on a claim file next to it.
+"""
+from __future__ import with_statement
+import fcntl
+import logging
+import os
+import shutil
+import sys
+
+from veh import clone
+
+COMPLETE = '.veh-seed-complete'
+
+logger = logging.getLogger(__name__)
+
+
+def seed_dir():
+    """The seed directory, VEH_SEED or ~/.veh/seed"""
+    return os.environ.get(
+        "VEH_SEED",
+        os.path.expanduser(os.path.join("~", ".veh", "seed")))
+
+
+def seed_path(seeddir, version=None):
+    """The seed for the python version, eg: 2.7, or this python."""
+    if not version:
+        version = "%d.%d" % sys.version_info[:2]
+    return os.path.join(seeddir, "python%s" % version)
+
+
+def make_seed(seeddir, create, version=None):
+    """Make the seed for the python version if there isn't one.
+
+    create is called with the path to create a virtualenv at, with the
+    python of version. Returns the seed path or None if the seed
+    couldn't be made.
+    """
+    seed = seed_path(seeddir, version)
+    if os.path.exists(os.path.join(seed, COMPLETE)):
+        return seed
+    if not os.path.exists(seeddir):
+        os.makedirs(seeddir)
+    # Claim the seed, only one process gets the lock
+    claim = "%s.creating" % seed
+    fd = os.open(claim, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            return None
+        if os.path.exists(os.path.join(seed, COMPLETE)):
+            # made while we were getting the lock
+            return seed
+        if os.path.exists(seed):
+            # left over from a seed that didn't get made
+            shutil.rmtree(seed)
+        create(seed)
+        if not os.path.exists(os.path.join(seed, 'bin', 'python')):
+            logger.warning("could not make a seed virtualenv at %s" % seed)
+            return None
+        open(os.path.join(seed, COMPLETE), "w").close()
+        return seed
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+
+def create_from_seed(seeddir, venvpath, create, version=None):
+    """Create a virtualenv at venvpath from the seed.
+
+    The seed, of the python version, is made with create first if need
+    be. Returns venvpath, or None if there's no seed to create from.
+    """
+    seed = make_seed(seeddir, create, version)
+    if not seed:
+        return None
+    clone.clone_virtualenv(seed, venvpath, strategy='reflink')
+    os.remove(os.path.join(venvpath, COMPLETE))
+    return venvpath
+
+# End
@@ -0,0 +1,214 @@
+"""A long running veh daemon for answering veh queries quickly.
+
+Starting python, importing veh and walking up the filesystem looking
+for .veh.conf costs a lot more than the answer to "veh check". The
+daemon keeps the answers - repository roots, parsed configs and active
+venvs - cached and answers queries from the tiny vehc client over a
+unix socket.
+
+Cached answers are checked against the mtimes of the things they were
+worked out from, so they're never stale:
+
+- a repository root is checked against the mtimes of every directory
+  walked to find it (creating or removing .veh.conf in any of them
+  changes the directory's mtime)
+- a config is checked against the mtime and size of .veh.conf
+- an active venv is checked against the .active link
+
+The protocol is one request line per connection:
+
+  COMMAND <tab> CWD <tab> ROOT <tab> VIRTUAL_ENV <newline>
+
+where ROOT is the -R option or empty, and the response is the exit
+status on the first line followed by the command's output. The
+connection is closed after the response.
+"""
+from __future__ import with_statement
+import os
+import signal
+import socket
+import sys
+import threading
+from ConfigParser import ConfigParser
+from SocketServer import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+from veh import VENV_DIR, ACTIVEFILE, BUILDING_FILE
+
+CFN = '.veh.conf'
+
+
+def socket_path():
+    """The daemon's socket, VEH_SOCKET or ~/.veh/daemon.sock"""
+    return os.environ.get(
+        "VEH_SOCKET",
+        os.path.expanduser(os.path.join("~", ".veh", "daemon.sock")))
+
+
+def _mtime(path):
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+class Resolver(object):
+    """Caches roots, configs and active venvs."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = {}
+        self.configs = {}
+        self.actives = {}
+
+    def _fresh(self, stamps):
+        for path, stamp in stamps:
+            if _mtime(path) != stamp:
+                return False
+        return True
+
+    def find_root(self, start):
+        """Like veh.find_root_with_file(CFN, start) but returns None
+        instead of raising if there's no root."""
+        start = os.path.abspath(start)
+        with self.lock:
+            cached = self.roots.get(start)
+        if cached and self._fresh(cached[1]):
+            return cached[0]
+
+        root = None
+        stamps = []
+        fulldir = start
+        while True:
+            stamps.append((fulldir, _mtime(fulldir)))
+            if os.path.exists(os.path.join(fulldir, CFN)):
+                root = fulldir
+                break
+            fulldir = os.path.dirname(fulldir)
+            if fulldir == "/":
+                break
+        with self.lock:
+            self.roots[start] = (root, stamps)
+        return root
+
+    def config(self, root):
+        cfgfile = os.path.join(root, CFN)
+        stamp = _mtime(cfgfile)
+        with self.lock:
+            cached = self.configs.get(cfgfile)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        cfg = ConfigParser()
+        with open(cfgfile) as fd:
+            cfg.readfp(fd, CFN)
+        with self.lock:
+            self.configs[cfgfile] = (stamp, cfg)
+        return cfg
+
+    def active(self, root):
+        """The active venv of root if it exists."""
+        activefile = os.path.join(root, VENV_DIR, ACTIVEFILE)
+        try:
+            st = os.lstat(activefile)
+        except OSError, e:
+            return None
+        stamp = (st.st_ino, st.st_mtime)
+        with self.lock:
+            cached = self.actives.get(activefile)
+        if cached and cached[0] == stamp:
+            venv = cached[1]
+        else:
+            venv = os.path.realpath(activefile)
+            with self.lock:
+                self.actives[activefile] = (stamp, venv)
+        if not os.path.exists(venv):
+            return None
+        return venv
+
+    def getroot(self, cwd, root=None):
+        """Like veh.VehCmd._getroot"""
+        if root:
+            return os.path.realpath(os.path.expanduser(root))
+        return os.path.realpath(self.find_root(cwd) or cwd)
+
+    def query(self, command, cwd, root=None, virtual_env=None):
+        """Answer a query, returns (status, output)."""
+        root = self.getroot(cwd, root)
+        if command == "root":
+            return 0, "%s\n" % root
+        elif command == "check":
+            active = self.active(root)
+            if active and not os.path.exists(os.path.join(active, BUILDING_FILE)):
+                return 0, "%s\n" % root
+            return 1, ""
+        elif command == "active":
+            active = self.active(root)
+            if (active and virtual_env
+                and os.path.abspath(virtual_env) == os.path.abspath(active)):
+                return 0, "%s\n" % virtual_env
+            return 1, ""
+        elif command == "lspackages":
+            cfg = self.config(root)
+            return 0, "".join("%s %s\n" % p for p in cfg.items("packages"))
+        return 2, "unknown command %s\n" % command
+
+
+class Handler(StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().rstrip("\n")
+        try:
+            command, cwd, root, virtual_env = line.split("\t")
+            status, output = self.server.resolver.query(
+                command, cwd, root or None, virtual_env or None)
+        except Exception, e:
+            status, output = 2, "%s\n" % e
+        self.wfile.write("%d\n%s" % (status, output))
+
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.resolver = Resolver()
+        UnixStreamServer.__init__(self, path, Handler)
+
+
+def serve(path=None):
+    """Run the daemon on the socket path until it's killed.
+
+    Only the user running the daemon can connect to it: the socket is
+    only accessible by the user and has to be in a directory the user
+    owns.
+    """
+    path = path or socket_path()
+    sockdir = os.path.dirname(path)
+    if not os.path.exists(sockdir):
+        os.makedirs(sockdir, 0700)
+    if os.stat(sockdir).st_uid != os.getuid():
+        raise Exception("%s is not owned by you" % sockdir)
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            # left over from a daemon that died
+            os.remove(path)
+        else:
+            sock.close()
+            raise Exception("a veh daemon is already running on %s" % path)
+    # the socket must never be accessible by anyone else
+    umask = os.umask(0077)
+    try:
+        server = Server(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0600)
+    # so the socket is removed when we're killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(path)
+
+# End
@@ -0,0 +1,154 @@
+"""Hardlink identical files across virtualenvs.
+
+The venvs of a repository are mostly the same files: only the files
+veh.clone's fixups rewrite differ. Deduping hashes the files of the
+venvs of each repository and replaces each file identical to the
+file at the same path in another of the repository's venvs with a
+hardlink to it, so each distinct file is only stored once per
+repository. Files are never linked between repositories, or within a
+venv.
+
+Only files that are never rewritten in place are linked. These are
+left alone:
+
+- files clone._rewritable says the fixups, veh or python might
+  rewrite: the files at the top of the venv, bin/, *.pth, *.egg-link,
+  *.pyc and *.pyo
+- symlinks
+- files that differ in mode or owner, or are on different devices
+
+A file is replaced by linking the file it duplicates to a temporary
+name next to it and renaming that over it, so the file is always
+there.
+
+The hashes are kept in a JSON index, against each file's inode, size
+and mtime, so only new and changed files are hashed again on the next
+run.
+"""
+from __future__ import with_statement
+import logging
+import os
+from hashlib import sha1
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from veh import clone
+
+logger = logging.getLogger(__name__)
+
+
+def load_index(indexfile):
+    try:
+        with open(indexfile) as fd:
+            return json.load(fd)
+    except (IOError, ValueError), e:
+        return {}
+
+
+def save_index(indexfile, index):
+    tmpfile = "%s.tmp" % indexfile
+    with open(tmpfile, "w") as out:
+        json.dump(index, out)
+    os.rename(tmpfile, indexfile)
+
+
+def _hash(path):
+    digest = sha1()
+    with open(path, "rb") as fd:
+        while True:
+            data = fd.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _files(venvdir):
+    """The paths of the files in venvdir that can be linked."""
+    for dirpath, dirnames, filenames in os.walk(venvdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path):
+                continue
+            if clone._rewritable(os.path.relpath(path, venvdir)):
+                continue
+            yield path
+
+
+def _replace(path, original):
+    """Replace path with a hardlink to original."""
+    tmpfile = "%s.veh-dedupe" % path
+    if os.path.lexists(tmpfile):
+        os.remove(tmpfile)
+    os.link(original, tmpfile)
+    try:
+        os.rename(tmpfile, path)
+    except:
+        os.remove(tmpfile)
+        raise
+
+
+def dedupe(repos, indexfile):
+    """Hardlink the identical files of the venvs of each repository.
+
+    repos is an iterable of lists of venvdirs, each the venvs of one
+    repository. Files are only linked between venvs of the same list.
+
+    Returns (linked, saved), the number of files that were replaced by
+    links and the bytes that freed.
+    """
+    index = load_index(indexfile)
+    newindex = {}
+    linked = saved = 0
+    for venvdirs in repos:
+        l, s = _dedupe_repo(venvdirs, index, newindex)
+        linked += l
+        saved += s
+    save_index(indexfile, newindex)
+    return linked, saved
+
+
+def _dedupe_repo(venvdirs, index, newindex):
+    """Hardlink the identical files across the venvdirs."""
+    # (relpath, hash, size, mode, uid, gid, dev): path of the first such file
+    seen = {}
+    linked = saved = 0
+    for venvdir in venvdirs:
+        for path in _files(venvdir):
+            try:
+                st = os.lstat(path)
+            except OSError, e:
+                # removed while we were looking
+                continue
+            stamp = [st.st_ino, st.st_size, st.st_mtime]
+            entry = index.get(path)
+            if entry and entry[:3] == stamp:
+                digest = entry[3]
+            else:
+                try:
+                    digest = _hash(path)
+                except IOError, e:
+                    continue
+            key = (os.path.relpath(path, venvdir), digest,
+                   st.st_size, st.st_mode, st.st_uid, st.st_gid, st.st_dev)
+            original = seen.get(key)
+            if original is None:
+                seen[key] = path
+            elif os.lstat(original).st_ino != st.st_ino:
+                try:
+                    _replace(path, original)
+                except OSError, e:
+                    # too many links to the original, say
+                    logger.warning("could not link %s to %s: %s" % (path, original, e))
+                else:
+                    if st.st_nlink == 1:
+                        saved += st.st_size
+                    linked += 1
+                    st = os.lstat(path)
+                    stamp = [st.st_ino, st.st_size, st.st_mtime]
+            newindex[path] = stamp + [digest]
+    return linked, saved
+
+# End
@@ -1,8 +1,58 @@
+import os
+import sys
+from subprocess import Popen
+
 import mercurial.node
 
 CFN = '.veh.conf'
 
 
+def _config_changed_since(repo, startrev):
+    """Did any changeset from startrev on add, change or remove .veh.conf?
+
+    The changesets' file lists are checked rather than the .veh.conf
+    filelog: a changeset going back to an earlier .veh.conf doesn't add
+    a filelog revision, and a filelog revision's linkrev can be an
+    older changeset that made the same change.
+    """
+    for rev in repo.changelog.revs(startrev):
+        if CFN in repo[rev].files():
+            return True
+    return False
+
+
+def _new_heads(repo, startrev):
+    """The heads that are changesets from startrev on."""
+    return [repo[head] for head in repo.heads()
+            if repo.changelog.rev(head) >= startrev]
+
+
+def _filenode(ctx):
+    if CFN in ctx:
+        return ctx[CFN].filenode()
+    return None
+
+
+def _prebuild(ui, repo, rev):
+    """Start building the venv for rev in the background.
+
+    Only happens if the hgrc says:
+
+    [veh]
+    prebuild = true
+    """
+    if not ui.configbool('veh', 'prebuild', False):
+        return
+    # the veh of this python, veh needn't be on the PATH
+    devnull = open(os.devnull, 'r+')
+    try:
+        Popen([sys.executable, '-m', 'veh', '-R', repo.root, 'prebuild', rev],
+              stdin=devnull, stdout=devnull, stderr=devnull,
+              close_fds=True, preexec_fn=os.setsid)
+    finally:
+        devnull.close()
+
+
 def warn_changes(ui, repo, hooktype, **kwargs):
     """hg hook to monitor changes of .veh.conf in pull and update.
 
@@ -11,42 +61,44 @@ def warn_changes(ui, repo, hooktype, **kwargs):
     changegroup.veh=python:veh.hooks.warn_changes
     preupdate.veh=python:veh.hooks.warn_changes
 
+    and to build the venv for the changed config in the background:
+    [veh]
+    prebuild = true
+
     """
     try:
         if hooktype == 'changegroup':
             warning = "WARNING: .veh.conf has been modified in changesets.\n"
             node = kwargs['node']
-    #        if CFN in repo[node].files():
-    #            ui.warn(warning)
-    #        else:
-    #            for ctx in repo[node].descendants():
-    #                if CFN in ctx.files():
-    #                    ui.warn(warning)
-    #                    break
             bnid = mercurial.node.bin(node)
-            for rev in xrange(repo.changelog.rev(bnid), len(repo.changelog)):
-                ctx = repo[repo.changelog.node(rev)]
-                if CFN in ctx.files():
-                    ui.warn(warning)
-                    break
+            startrev = repo.changelog.rev(bnid)
+            if _config_changed_since(repo, startrev):
+                ui.warn(warning)
+                # tip is only one of the heads the changesets can make
+                for head in _new_heads(repo, startrev):
+                    _prebuild(ui, repo, head.hex())
         elif hooktype == 'preupdate':
             warning = "WARNING: update modifying .veh.conf\n"
-            wd = repo[None]
+            current = repo['.']
             parent = None
             parent1 = repo[kwargs['parent1']]
             parent2 = kwargs.get('parent2')
             parent2 = parent2 and repo[parent2]
             if parent1.node() not in repo.dirstate.parents():
                 parent = parent1
-            elif parent2 and parent2 not in repo.dirstate.parents():
+            elif parent2 and parent2.node() not in repo.dirstate.parents():
                 parent = parent2
             if parent:
-                if CFN in parent and CFN in wd:
-                    if not parent[CFN].cmp(wd[CFN].data()):
-                        ui.warn(warning)
-                elif CFN not in parent and CFN in wd:
+                target, now = _filenode(parent), _filenode(current)
+                if target == now:
+                    return
+                if target and now:
+                    ui.warn(warning)
+                elif not target and now:
                     ui.warn('WARNING: update removing .veh.conf\n')
-                elif CFN in parent and CFN not in wd:
+                elif target and not now:
                     ui.warn('WARNING: update adding .veh.conf\n')
+                if target:
+                    _prebuild(ui, repo, parent.hex())
     except Exception, e:
-        ui.error('whoops! %s' % e)
+        ui.warn('whoops! %s\n' % e)
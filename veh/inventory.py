@@ -0,0 +1,183 @@
+"""Inventory of the packages installed in a virtualenv.
+
+Rather than running "pip freeze" inside the virtualenv this reads the
+installation metadata in site-packages directly:
+
+- *.dist-info directories (METADATA)
+- *.egg-info directories and files (PKG-INFO)
+- *.egg directories and zipfiles (EGG-INFO/PKG-INFO)
+- *.egg-link files, for packages installed in develop mode, which point
+  at a directory containing an *.egg-info
+
+Scanning a site-packages directory gives a map of project name to
+version. The map is cached, in this process and in the INVENTORY_FILE
+inside the virtualenv, against the mtime of the site-packages
+directory. Installing or removing anything in site-packages changes
+the directory's mtime so the cache is never stale for normal installs.
+"""
+from __future__ import with_statement
+import os
+import re
+import zipfile
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+INVENTORY_FILE = '.veh-inventory'
+
+# The name and version from the name of an egg-info or dist-info
+_FILENAME_RE = re.compile(r"^(?P<name>[^-]+)-(?P<version>[^-]+)(-.*)?\.(egg|egg-info|dist-info)$")
+
+# sitedir: (mtime, {name: version})
+_cache = {}
+
+
+def normalize_name(name):
+    """Project names compare case insensitively and with - and _ the same."""
+    return name.lower().replace("_", "-")
+
+
+def site_packages(venvdir):
+    """The site-packages directories of the virtualenv."""
+    dirs = []
+    for libdir in [os.path.join(venvdir, 'lib'),
+                   os.path.join(venvdir, 'local', 'lib')]:
+        if not os.path.isdir(libdir) or os.path.islink(libdir):
+            continue
+        for pylib in sorted(os.listdir(libdir)):
+            sitedir = os.path.join(libdir, pylib, 'site-packages')
+            if pylib.startswith('python') and os.path.isdir(sitedir):
+                dirs.append(sitedir)
+    return dirs
+
+
+def _parse_metadata(lines):
+    """Get the Name and Version out of PKG-INFO or METADATA lines."""
+    name = version = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            # the end of the headers
+            break
+        if line.startswith("Name:"):
+            name = line[len("Name:"):].strip()
+        elif line.startswith("Version:"):
+            version = line[len("Version:"):].strip()
+    return name, version
+
+
+def _read_metadata(path):
+    try:
+        with open(path) as fd:
+            return _parse_metadata(fd)
+    except IOError, e:
+        return None, None
+
+
+def _read_zipped_metadata(path):
+    try:
+        egg = zipfile.ZipFile(path)
+        try:
+            return _parse_metadata(egg.read("EGG-INFO/PKG-INFO").splitlines())
+        finally:
+            egg.close()
+    except (IOError, KeyError, zipfile.BadZipfile), e:
+        return None, None
+
+
+def _egg_link_metadata(path):
+    """Find the metadata of the develop install the egg-link points at."""
+    with open(path) as fd:
+        target = fd.readline().strip()
+    if not os.path.isdir(target):
+        return None, None
+    for name in os.listdir(target):
+        if name.endswith('.egg-info'):
+            return _read_metadata(os.path.join(target, name, 'PKG-INFO'))
+    return None, None
+
+
+def scan(sitedir):
+    """Read the name and version of everything installed in sitedir."""
+    packages = {}
+    for entry in os.listdir(sitedir):
+        full = os.path.join(sitedir, entry)
+        name = version = None
+        if entry.endswith('.dist-info'):
+            name, version = _read_metadata(os.path.join(full, 'METADATA'))
+        elif entry.endswith('.egg-info'):
+            if os.path.isdir(full):
+                full = os.path.join(full, 'PKG-INFO')
+            name, version = _read_metadata(full)
+        elif entry.endswith('.egg'):
+            if os.path.isdir(full):
+                name, version = _read_metadata(os.path.join(full, 'EGG-INFO', 'PKG-INFO'))
+            else:
+                name, version = _read_zipped_metadata(full)
+        elif entry.endswith('.egg-link'):
+            name, version = _egg_link_metadata(full)
+        else:
+            continue
+
+        if not (name and version):
+            # fall back to the filename
+            m = _FILENAME_RE.match(entry)
+            if not m:
+                continue
+            name = name or m.group("name").replace("_", "-")
+            version = version or m.group("version").replace("_", "-")
+        packages[name] = version
+    return packages
+
+
+def _load(venvdir):
+    path = os.path.join(venvdir, INVENTORY_FILE)
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, ValueError), e:
+        return {}
+
+
+def _save(venvdir, stored):
+    path = os.path.join(venvdir, INVENTORY_FILE)
+    tmpfile = "%s.tmp" % path
+    try:
+        with open(tmpfile, "w") as out:
+            json.dump(stored, out)
+        os.rename(tmpfile, path)
+    except (IOError, OSError), e:
+        # just a cache
+        pass
+
+
+def installed(venvdir):
+    """Map the name of every package installed in the venv to its version."""
+    packages = {}
+    stored = None
+    changed = False
+    for sitedir in site_packages(venvdir):
+        mtime = os.stat(sitedir).st_mtime
+        cached = _cache.get(sitedir)
+        if not cached or cached[0] != mtime:
+            if stored is None:
+                stored = _load(venvdir)
+            cached = stored.get(sitedir)
+            if not cached or cached[0] != mtime:
+                cached = (mtime, scan(sitedir))
+                stored[sitedir] = cached
+                changed = True
+            _cache[sitedir] = cached
+        packages.update(cached[1])
+    if changed:
+        _save(venvdir, stored)
+    return packages
+
+
+def index(packages):
+    """Index the installed packages map by normalized name."""
+    return dict((normalize_name(name), version)
+                for name, version in packages.iteritems())
+
+# End
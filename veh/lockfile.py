@@ -0,0 +1,145 @@
+"""The veh lock file, exact pins of everything in a built virtualenv.
+
+The lock file, LOCK_FILE next to .veh.conf, pins the whole of a built
+virtualenv's dependency closure:
+
+  # veh lock of config 563546ac9fa55612ef405825a3854c02812a026c
+  Django==1.3 --hash=sha256:...
+  South==0.7.3 --hash=sha256:...
+  hg+http://domain/repo@1.2#egg=repo
+
+Packages from the package index are pinned to a version and the hash
+of their artifact. A virtualenv is built from those with no resolution
+and no dependency walking:
+
+  pip install --no-deps --require-hashes -r PINS
+
+Packages that aren't on the package index, vc references, urls and
+paths, can't be pinned by hash so they are locked by their spec from
+the config and installed separately, also with --no-deps.
+
+The header records the config_key of the config the lock was made
+from. A lock is only current for a config with the same key: editing
+the [packages] section or the [pip] options that change what gets
+installed, or using another major.minor version of python, makes it
+stale. Anything else, the python patch release or where the caches
+are, doesn't, so one lock works on every host.
+"""
+from __future__ import with_statement
+import os
+import re
+import sys
+from hashlib import sha1, sha256
+
+from veh import inventory
+
+LOCK_FILE = '.veh.lock'
+
+# The installers themselves are never locked
+UNLOCKED = ['pip', 'setuptools', 'wheel', 'distribute']
+
+# The [pip] options that change what gets installed
+PIP_OPTIONS = ['index-url']
+
+HEADER = "# veh lock of config %s"
+_HEADER_RE = re.compile(r"^# veh lock of config (?P<key>\w+)$")
+
+
+def config_key(cfg, version=None):
+    """The key of the config a lock is current for.
+
+    version is the major.minor version of the python the venv is built
+    with, eg: 2.7, the python running this if it's None.
+
+    Package labels are case insensitive and the order of packages
+    doesn't matter to the key.
+    """
+    h = sha1()
+    h.update("python %s\n" % (version or "%d.%d" % sys.version_info[:2]))
+    h.update("[packages]\n")
+    for label, spec in sorted((k.strip().lower(), v.strip())
+                              for k, v in cfg.items("packages")):
+        h.update("%s = %s\n" % (label, spec))
+    h.update("[pip]\n")
+    for option in PIP_OPTIONS:
+        if cfg.has_option("pip", option):
+            h.update("%s = %s\n" % (option, cfg.get("pip", option).strip()))
+    return h.hexdigest()
+
+
+def lock_path(repo):
+    return os.path.join(repo, LOCK_FILE)
+
+
+def file_hash(path):
+    """The pip hash, "sha256:HEX", of the artifact at path."""
+    digest = sha256()
+    with open(path, "rb") as fd:
+        while True:
+            data = fd.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    return "sha256:%s" % digest.hexdigest()
+
+
+def closure(installed):
+    """The (name, version) pins for the installed packages map."""
+    return sorted(
+        [(name, version) for name, version in installed.iteritems()
+         if inventory.normalize_name(name) not in UNLOCKED],
+        key=lambda pin: inventory.normalize_name(pin[0]))
+
+
+def write(repo, key, pins, specs):
+    """Write the lock of the config key.
+
+    pins is a list of (name, version, hash) and specs the list of
+    specs that are locked as they are.
+    """
+    path = lock_path(repo)
+    tmpfile = "%s.tmp" % path
+    with open(tmpfile, "w") as out:
+        print >>out, HEADER % key
+        for name, version, digest in pins:
+            print >>out, "%s==%s --hash=%s" % (name, version, digest)
+        for spec in specs:
+            print >>out, spec
+    os.rename(tmpfile, path)
+
+
+def read(repo):
+    """Read the lock, returns (key, lines) or (None, []) if there isn't one."""
+    path = lock_path(repo)
+    if not os.path.exists(path):
+        return None, []
+    key = None
+    lines = []
+    with open(path) as fd:
+        for line in fd:
+            line = line.strip()
+            m = _HEADER_RE.match(line)
+            if m:
+                key = m.group("key")
+            elif line and not line.startswith("#"):
+                lines.append(line)
+    return key, lines
+
+
+def current(repo, key):
+    """Is there a lock current for the config key?"""
+    lockkey, lines = read(repo)
+    return lockkey == key and bool(lines)
+
+
+def split(lines):
+    """Split the lock's lines into (pins, specs).
+
+    pip checks hashes for every package once any has one, so the pins
+    and the specs must be installed by separate pip runs.
+    """
+    pins = [line for line in lines if "--hash=" in line]
+    specs = [line for line in lines if "--hash=" not in line]
+    return pins, specs
+
+# End
@@ -0,0 +1,70 @@
+"""Fetch package artifacts ahead of installing them.
+
+Installing packages one at a time means each package is only
+downloaded when its turn comes and the network and the installs never
+overlap. A Prefetcher starts fetching every package straight away, in a
+bounded pool of worker threads, and the install loop waits for each
+package's fetch just before installing it, by which time it's usually
+done.
+
+The fetching itself is whatever function the Prefetcher is given, veh
+runs the venv's "pip download" into the pip download cache. The output
+of each fetch is kept rather than written out, so the fetches going on
+at once don't mix up their output, and the install loop reports the
+fetches that failed.
+"""
+import logging
+import time
+
+WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher(object):
+    """Runs fetch(item) for items in a pool of worker threads.
+
+    fetch returns (status, output), status is an exit status, 0 for
+    success.
+    """
+
+    def __init__(self, fetch, workers=WORKERS):
+        self.fetch = fetch
+        self.workers = workers
+        self.pool = None
+        self.results = {}
+
+    def _fetch(self, item):
+        started = time.time()
+        try:
+            status, output = self.fetch(item)
+        except Exception, e:
+            status, output = -1, "%s\n" % e
+        return status, time.time() - started, output
+
+    def start(self, items):
+        """Start fetching the items, in order."""
+        items = [item for item in items if item not in self.results]
+        if not items:
+            return
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(min(self.workers, len(items)))
+        for item in items:
+            self.results[item] = self.pool.apply_async(self._fetch, (item,))
+        # no more work
+        self.pool.close()
+
+    def __contains__(self, item):
+        return item in self.results
+
+    def wait(self, item):
+        """Wait for the item to be fetched, returns (status, seconds, output)."""
+        return self.results[item].get()
+
+    def close(self):
+        """Wait for all the fetches to finish."""
+        if self.pool is not None:
+            self.pool.join()
+            self.pool = None
+
+# End
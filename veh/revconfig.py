@@ -0,0 +1,205 @@
+"""Read the veh config at historical revisions of hg and git repositories.
+
+A reader is kept open per repository so reading the config at many
+revisions doesn't pay the repository setup each time:
+
+- for mercurial one repository object is kept
+- for git one "git cat-file --batch" process is kept
+
+A reader is only kept while the repository's history and refs haven't
+changed, going by the mtimes of the files that record them, so a long
+running process like the veh daemon never reads stale state.
+
+The config is the .veh.conf of the veh root, which needn't be the root
+of the hg or git repository.
+
+Parsed configs are cached by the file-node (hg) or blob (git) hash of
+.veh.conf so revisions that share a config share the parsed config.
+The parsed configs are shared, don't change them.
+"""
+from __future__ import with_statement
+import os
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+from subprocess import Popen, PIPE
+
+CFN = '.veh.conf'
+
+
+def _parse(data):
+    cfg = ConfigParser()
+    cfg.readfp(StringIO(data), CFN)
+    return cfg
+
+
+class RevisionNotFound(Exception):
+    """The revision does not exist in the repository"""
+    pass
+
+
+def _stamp(paths):
+    """The mtimes and sizes of paths, None for the missing ones."""
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_mtime, st.st_size))
+    return stamp
+
+
+class HgReader(object):
+    """Reads the config with one mercurial repository object."""
+
+    @staticmethod
+    def stamp(root):
+        """Changes when a commit, bookmark or local tag is made."""
+        hgdir = os.path.join(root, '.hg')
+        return _stamp([os.path.join(hgdir, 'store', '00changelog.i'),
+                       os.path.join(hgdir, '00changelog.i'),
+                       os.path.join(hgdir, 'bookmarks'),
+                       os.path.join(hgdir, 'localtags')])
+
+    def __init__(self, root):
+        from mercurial import hg, ui
+        self.root = root
+        self.repo = hg.repository(ui.ui(), root)
+        self.parsed = {}
+
+    def read(self, rev, path=CFN):
+        """The config at path, relative to the repository root, at rev.
+
+        None if there's no config there.
+        """
+        from mercurial import error
+        try:
+            ctx = self.repo[rev]
+        except error.RepoLookupError, e:
+            raise RevisionNotFound(rev)
+        try:
+            fctx = ctx[path]
+        except error.LookupError, e:
+            return None
+        filenode = fctx.filenode()
+        if filenode not in self.parsed:
+            self.parsed[filenode] = _parse(fctx.data())
+        return self.parsed[filenode]
+
+    def close(self):
+        pass
+
+
+class GitReader(object):
+    """Reads the config with one "git cat-file --batch" process."""
+
+    @staticmethod
+    def stamp(root):
+        """Changes when HEAD or any ref moves."""
+        gitdir = os.path.join(root, '.git')
+        paths = [os.path.join(gitdir, 'HEAD'), os.path.join(gitdir, 'packed-refs')]
+        for dirpath, dirnames, filenames in os.walk(os.path.join(gitdir, 'refs')):
+            dirnames.sort()
+            paths += [os.path.join(dirpath, f) for f in sorted(filenames)]
+        return paths, _stamp(paths)
+
+    def __init__(self, root):
+        self.root = root
+        self.process = None
+        self.parsed = {}
+
+    def _cat(self, name):
+        """Ask cat-file for the object name.
+
+        Returns (hash, data) or None if the object is missing.
+        """
+        if self.process is None:
+            self.process = Popen(["git", "cat-file", "--batch"],
+                                 cwd=self.root, stdin=PIPE, stdout=PIPE)
+        self.process.stdin.write("%s\n" % name)
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            # "NAME missing" or "NAME ambiguous"
+            return None
+        objhash, objtype, size = header
+        data = self.process.stdout.read(int(size))
+        # the object is followed by a newline
+        self.process.stdout.read(1)
+        return objhash, data
+
+    def read(self, rev, path=CFN):
+        """The config at path, relative to the repository root, at rev.
+
+        None if there's no config there.
+        """
+        blob = self._cat("%s:%s" % (rev, path))
+        if blob is None:
+            if self._cat("%s^{commit}" % rev) is None:
+                raise RevisionNotFound(rev)
+            return None
+        blobhash, data = blob
+        if blobhash not in self.parsed:
+            self.parsed[blobhash] = _parse(data)
+        return self.parsed[blobhash]
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+
+# Open readers by repository root: (stamp, reader)
+_readers = {}
+
+
+def reader(repo):
+    """Get the open reader for the hg or git repository containing repo.
+
+    A new reader replaces the open one if the repository has changed.
+    """
+    fulldir = os.path.realpath(repo)
+    while True:
+        if os.path.exists(os.path.join(fulldir, '.hg')):
+            readerclass = HgReader
+            break
+        if os.path.exists(os.path.join(fulldir, '.git')):
+            readerclass = GitReader
+            break
+        newdir = os.path.dirname(fulldir)
+        if newdir == fulldir:
+            raise Exception("%s is not in a mercurial or git repository" % repo)
+        fulldir = newdir
+    stamp = readerclass.stamp(fulldir)
+    cached = _readers.get(fulldir)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    if cached:
+        cached[1].close()
+    r = readerclass(fulldir)
+    _readers[fulldir] = (stamp, r)
+    return r
+
+
+def config_path(repo, root):
+    """The path of the config of the veh root repo, relative to the
+    hg or git repository root."""
+    relpath = os.path.relpath(os.path.realpath(repo), root)
+    if relpath == os.curdir:
+        return CFN
+    return "/".join(relpath.split(os.sep) + [CFN])
+
+
+def read_configs(repo, revs):
+    """Read the config of the veh root repo at each of revs.
+
+    Returns a list of (rev, config) with config None where there's no
+    config at rev.
+    """
+    r = reader(repo)
+    path = config_path(repo, r.root)
+    return [(rev, r.read(rev, path)) for rev in revs]
+
+# End
@@ -0,0 +1,130 @@
+"""Content addressed store of built virtualenvs.
+
+Built virtualenvs are kept in a store directory (per user or per host)
+keyed by a hash of everything that goes into building them:
+
+- the normalized [packages] section of the veh config
+- the version of the python the virtualenv is built with
+- the [pip] options
+
+A repository that needs a virtualenv with the same key as one in the
+store can clone the stored one with veh.clone instead of building it
+from scratch.
+
+Store entries are only used once they have been completely written,
+which is marked by the COMPLETE file inside the entry. While an entry
+is being written the publisher holds an flock on a claim file next to
+it, which goes away with the publisher if it dies.
+"""
+from __future__ import with_statement
+import fcntl
+import logging
+import os
+import shutil
+import sys
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from veh import clone
+
+COMPLETE = '.veh-store-complete'
+PUBLISHING = '.publishing'
+
+logger = logging.getLogger(__name__)
+
+
+def _section_items(cfg, section):
+    if not cfg.has_section(section):
+        return []
+    return sorted((k.strip().lower(), v.strip()) for k, v in cfg.items(section))
+
+
+def config_key(cfg, version=None):
+    """Make the store key for the config.
+
+    version is the version of the python the venv is built with, eg:
+    2.7.18, the python running this if it's None.
+
+    Package labels are case insensitive (ConfigParser lowercases them
+    anyway) and the order of packages doesn't matter to the key.
+    """
+    h = sha1()
+    h.update("python %s\n" % (version or sys.version.split()[0]))
+    for section in ["packages", "pip"]:
+        h.update("[%s]\n" % section)
+        for label, spec in _section_items(cfg, section):
+            h.update("%s = %s\n" % (label, spec))
+    return h.hexdigest()
+
+
+def entry_path(storedir, key):
+    return os.path.join(storedir, key)
+
+
+def lookup(storedir, key):
+    """Return the path of the complete store entry for key or None."""
+    path = entry_path(storedir, key)
+    if os.path.exists(os.path.join(path, COMPLETE)):
+        return path
+    return None
+
+
+def materialize(storedir, key, dst_dir, strategy='copy'):
+    """Clone the store entry for key to dst_dir.
+
+    strategy is the veh.clone strategy used to copy the files.
+
+    Returns dst_dir or None if there is no complete entry for key.
+    """
+    path = lookup(storedir, key)
+    if not path:
+        return None
+    clone.clone_virtualenv(path, dst_dir, strategy)
+    os.remove(os.path.join(dst_dir, COMPLETE))
+    return dst_dir
+
+
+def publish(storedir, key, venv_path):
+    """Put a clone of the built venv_path in the store under key.
+
+    If the entry already exists, or another process is currently
+    writing it, nothing is done. Returns the path of the entry if it
+    was written.
+    """
+    if not os.path.exists(storedir):
+        os.makedirs(storedir)
+    path = entry_path(storedir, key)
+    if lookup(storedir, key):
+        return None
+
+    # Claim the entry, only one publisher gets the lock
+    claim = "%s%s" % (path, PUBLISHING)
+    fd = os.open(claim, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            return None
+        if lookup(storedir, key):
+            # published while we were getting the lock
+            return None
+        if os.path.exists(path):
+            # left over from a publish that died
+            shutil.rmtree(path)
+        try:
+            clone.clone_virtualenv(venv_path, path)
+        except Exception, e:
+            logger.warning("could not publish %s to the store: %s" % (venv_path, e))
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            return None
+        with open(os.path.join(path, COMPLETE), "w") as out:
+            print >>out, key
+        return path
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+# End
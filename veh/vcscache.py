@@ -0,0 +1,196 @@
+"""Shared mirrors of the repositories in vc package specs.
+
+For a vc spec like:
+
+  hg+http://domain/repo@1.2#egg=repo
+
+pip clones the whole repository from the server into a temporary
+directory on every install. With a vcs cache directory veh keeps one
+bare mirror per repository url instead:
+
+- hg mirrors are made with "hg clone -U" and updated with "hg pull"
+- git mirrors are made with "git clone --mirror" and updated with
+  "git fetch"
+
+so an install only pulls the changesets that are new since the last
+one, and the spec handed to pip is rewritten to the mirror:
+
+  hg+file:///CACHE/hg/SHA1@1.2#egg=repo
+
+from which pip's clone is local. The mirrors of all the specs being
+installed are updated in parallel.
+
+pip only installs hg+file:// specs from 19.3, so hg specs are only
+mirrored for a venv whose pip is at least that.
+
+Each mirror is locked while it's updated so veh processes can share a
+cache directory.
+"""
+from __future__ import with_statement
+import fcntl
+import logging
+import os
+import re
+import shutil
+from subprocess import Popen, PIPE, STDOUT
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+VCS = ['hg', 'git']
+WORKERS = 4
+
+# The first pip that installs vcs+file:// specs of each vcs
+FILE_URL_PIP = {'hg': (19, 3), 'git': (0,)}
+
+logger = logging.getLogger(__name__)
+
+
+def parse(spec):
+    """Split a vc spec into (vcs, url, rev, fragment).
+
+    rev and fragment are None if the spec doesn't have them. Returns
+    None if the spec isn't a vc spec veh can mirror.
+    """
+    if "+" not in spec:
+        return None
+    vcs, url = spec.split("+", 1)
+    if vcs not in VCS or "://" not in url:
+        return None
+    fragment = rev = None
+    if "#" in url:
+        url, fragment = url.split("#", 1)
+    scheme, path = url.split("://", 1)
+    # the rev follows an @ in the path, an @ before that is a user
+    slash = path.find("/")
+    if slash >= 0 and "@" in path[slash:]:
+        path, rev = path.rsplit("@", 1)
+    return vcs, "%s://%s" % (scheme, path), rev, fragment
+
+
+def _version_tuple(version):
+    """The leading numbers of a version, eg: 19.3.1 gives (19, 3, 1)."""
+    numbers = []
+    for part in version.split("."):
+        m = re.match(r"\d+", part)
+        if not m:
+            break
+        numbers.append(int(m.group()))
+    return tuple(numbers)
+
+
+def installable(vcs, pip_version=None):
+    """Can pip of pip_version install the vcs's file:// specs?
+
+    A pip_version of None is taken to be a recent pip.
+    """
+    return pip_version is None or _version_tuple(pip_version) >= FILE_URL_PIP[vcs]
+
+
+def mirror_path(cachedir, vcs, url):
+    return os.path.join(cachedir, vcs, sha1(url).hexdigest())
+
+
+def _clone_command(vcs, url, path):
+    if vcs == 'hg':
+        return ["hg", "clone", "-q", "-U", url, path]
+    return ["git", "clone", "-q", "--mirror", url, path]
+
+
+def _pull_command(vcs, url, path):
+    if vcs == 'hg':
+        return ["hg", "pull", "-q", "-R", path, url]
+    return ["git", "--git-dir=%s" % path, "fetch", "-q", "--prune", "origin"]
+
+
+def _run(command):
+    process = Popen(command, stdout=PIPE, stderr=STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        logger.warning("%s failed: %s" % (" ".join(command), output))
+    return process.returncode
+
+
+def update(cachedir, vcs, url):
+    """Make or update the mirror of url.
+
+    Returns the mirror's path or None if it couldn't be updated.
+    """
+    path = mirror_path(cachedir, vcs, url)
+    vcsdir = os.path.dirname(path)
+    if not os.path.exists(vcsdir):
+        try:
+            os.makedirs(vcsdir)
+        except OSError, e:
+            # someone else made it
+            if not os.path.isdir(vcsdir):
+                raise
+    fd = os.open("%s.lock" % path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            if _run(_pull_command(vcs, url, path)):
+                return None
+            return path
+        # clone next to the mirror so a failed clone is never used
+        tmppath = "%s.tmp" % path
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        if _run(_clone_command(vcs, url, tmppath)):
+            return None
+        os.rename(tmppath, path)
+        return path
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+
+def _rewrite(vcs, path, rev, fragment):
+    spec = "%s+file://%s" % (vcs, path)
+    if rev:
+        spec += "@%s" % rev
+    if fragment:
+        spec += "#%s" % fragment
+    return spec
+
+
+def mirror_specs(cachedir, specs, workers=WORKERS, pip_version=None):
+    """Update the mirrors of the vc specs in parallel.
+
+    Only the specs pip of pip_version can install from a mirror are
+    mirrored. Returns a dict of each vc spec whose mirror is up to date
+    to the spec rewritten to install from the mirror.
+    """
+    wanted = {}
+    for spec in specs:
+        parsed = parse(spec)
+        if parsed and installable(parsed[0], pip_version):
+            vcs, url, rev, fragment = parsed
+            wanted.setdefault((vcs, url), []).append((spec, rev, fragment))
+    if not wanted:
+        return {}
+
+    repos = sorted(wanted)
+    if workers > 1 and len(repos) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(repos)))
+        try:
+            results = [pool.apply_async(update, (cachedir, vcs, url))
+                       for vcs, url in repos]
+            mirrors = [result.get() for result in results]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        mirrors = [update(cachedir, vcs, url) for vcs, url in repos]
+
+    rewritten = {}
+    for (vcs, url), path in zip(repos, mirrors):
+        if not path:
+            continue
+        for spec, rev, fragment in wanted[(vcs, url)]:
+            rewritten[spec] = _rewrite(vcs, path, rev, fragment)
+    return rewritten
+
+# End
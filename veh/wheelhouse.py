@@ -0,0 +1,212 @@
+"""Local wheelhouse of built packages.
+
+Packages are built into wheels once and kept in a wheelhouse directory
+so new virtualenvs can install them without compiling anything and
+without going to the package index.
+
+The wheelhouse is laid out by interpreter ABI and then by a hash of the
+package spec:
+
+  wheelhouse/py2.7-linux-x86_64/<sha1 of spec>/*.whl
+
+Each entry holds the wheels for the package and all of its
+dependencies, as built by "pip wheel". The wheelhouse is shared so
+entries are built in a temporary directory next to them and renamed
+into place once the build has succeeded, with the SPECFILE written
+into them.
+
+Each entry has a lock file next to it, "<sha1 of spec>.lock". While an
+entry is being installed from its lock is held shared (see use) and
+prune only removes an entry when it can lock it exclusively, so an
+entry is never removed while it is in use.
+"""
+from __future__ import with_statement
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+from distutils.util import get_platform
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+SPECFILE = '.veh-spec'
+BUILDING_PREFIX = '.building-'
+
+
+def abi_tag(venvdir):
+    """The interpreter ABI of the venv, eg: py2.7-linux-x86_64.
+
+    This is worked out from the venv's lib directory so the venv's
+    python isn't started.
+    """
+    libdir = os.path.join(venvdir, 'lib')
+    versions = sorted(d for d in os.listdir(libdir) if d.startswith('python'))
+    if not versions:
+        raise Exception("no python lib directory in %s" % venvdir)
+    return "py%s-%s" % (versions[-1][len('python'):], get_platform())
+
+
+def entry_dir(wheelhouse, abi, spec):
+    return os.path.join(wheelhouse, abi, sha1(spec).hexdigest())
+
+
+def _lock(entry, how):
+    """Open the entry's lock file and flock it, returns the open file.
+
+    Closing the file releases the lock.
+    """
+    lockfile = open("%s.lock" % entry, "a")
+    try:
+        fcntl.flock(lockfile.fileno(), how)
+    except:
+        lockfile.close()
+        raise
+    return lockfile
+
+
+def lookup(wheelhouse, abi, spec):
+    """Return the entry directory for spec if it has been built, else None.
+
+    Looking an entry up marks it as used for pruning.
+    """
+    entry = entry_dir(wheelhouse, abi, spec)
+    specfile = os.path.join(entry, SPECFILE)
+    if not os.path.exists(specfile):
+        return None
+    os.utime(specfile, None)
+    return entry
+
+
+def use(wheelhouse, abi, spec):
+    """Look the entry for spec up and hold it so it isn't pruned.
+
+    Returns (entry, lock) or None if the entry hasn't been built. The
+    entry is held until lock is closed.
+    """
+    entry = entry_dir(wheelhouse, abi, spec)
+    if not os.path.isdir(os.path.dirname(entry)):
+        return None
+    lock = _lock(entry, fcntl.LOCK_SH)
+    if not lookup(wheelhouse, abi, spec):
+        lock.close()
+        return None
+    return entry, lock
+
+
+def build_command(entry):
+    """The pip command that builds wheels into the entry.
+
+    The spec is added by the caller.
+    """
+    return "pip wheel --wheel-dir=%s" % entry
+
+
+def prepare(wheelhouse, abi, spec):
+    """Make an empty directory for building spec into.
+
+    The directory is private to the caller, see complete.
+    """
+    abidir = os.path.join(wheelhouse, abi)
+    if not os.path.exists(abidir):
+        try:
+            os.makedirs(abidir)
+        except OSError, e:
+            # someone else made it
+            if not os.path.isdir(abidir):
+                raise
+    return tempfile.mkdtemp(prefix=BUILDING_PREFIX, dir=abidir)
+
+
+def complete(wheelhouse, abi, spec, builddir):
+    """Put the successfully built builddir in place as spec's entry.
+
+    If someone else built the entry first builddir is thrown away.
+    Returns (entry, lock) like use.
+    """
+    with open(os.path.join(builddir, SPECFILE), "w") as out:
+        print >>out, spec
+    entry = entry_dir(wheelhouse, abi, spec)
+    # holding the lock shared stops prune, renaming is atomic
+    lock = _lock(entry, fcntl.LOCK_SH)
+    try:
+        if os.path.exists(entry) and not os.path.exists(os.path.join(entry, SPECFILE)):
+            # an unfinished entry, nothing uses those
+            stale = tempfile.mkdtemp(prefix=BUILDING_PREFIX, dir=os.path.dirname(entry))
+            os.rename(entry, os.path.join(stale, "entry"))
+            shutil.rmtree(stale)
+        try:
+            os.rename(builddir, entry)
+        except OSError, e:
+            # someone else's build got there first
+            if not os.path.exists(os.path.join(entry, SPECFILE)):
+                raise
+            shutil.rmtree(builddir)
+    except:
+        lock.close()
+        raise
+    return entry, lock
+
+
+def abandon(builddir):
+    """Throw away a build that failed."""
+    shutil.rmtree(builddir)
+
+
+def entries(wheelhouse):
+    """List the wheelhouse as (abi, spec, entry, lastused) tuples."""
+    result = []
+    if not os.path.isdir(wheelhouse):
+        return result
+    for abi in sorted(os.listdir(wheelhouse)):
+        abidir = os.path.join(wheelhouse, abi)
+        if not os.path.isdir(abidir):
+            continue
+        for name in os.listdir(abidir):
+            entry = os.path.join(abidir, name)
+            if not os.path.isdir(entry):
+                # the lock files
+                continue
+            specfile = os.path.join(entry, SPECFILE)
+            if os.path.exists(specfile):
+                with open(specfile) as fd:
+                    spec = fd.read().strip()
+                lastused = os.stat(specfile).st_mtime
+            else:
+                # an unfinished build
+                spec = None
+                lastused = os.stat(entry).st_mtime
+            result.append((abi, spec, entry, lastused))
+    return result
+
+
+def prune(wheelhouse, days):
+    """Remove entries that haven't been used for days.
+
+    Entries that are in use are left alone, as are builds that have
+    been going for less than days. Returns the list of removed entries.
+    """
+    cutoff = time.time() - days * 24 * 60 * 60
+    removed = []
+    for abi, spec, entry, lastused in entries(wheelhouse):
+        if lastused >= cutoff:
+            continue
+        if os.path.basename(entry).startswith(BUILDING_PREFIX):
+            shutil.rmtree(entry)
+            removed.append(entry)
+            continue
+        try:
+            lock = _lock(entry, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            # in use
+            continue
+        try:
+            shutil.rmtree(entry)
+        finally:
+            lock.close()
+        removed.append(entry)
+    return removed
+
+# End